@@ -9,6 +9,8 @@ model. It is used to answer assignment 4.
 # Import statements
 from random import random
 
+import numpy as np
+
 
 # Background amino acid probabilities
 pa = {'A': 0.074, 'C': 0.025, 'D': 0.054, 'E': 0.054, 'F': 0.047, 'G': 0.074,
@@ -16,6 +18,14 @@ pa = {'A': 0.074, 'C': 0.025, 'D': 0.054, 'E': 0.054, 'F': 0.047, 'G': 0.074,
       'P': 0.039, 'Q': 0.034, 'R': 0.052, 'S': 0.057, 'T': 0.051, 'V': 0.073,
       'W': 0.013, 'Y': 0.034}
 
+# Fixed residue and transition order used by the log-space arrays
+AMINO_ACIDS = list(pa.keys())
+AA_INDEX = {aa: i for i, aa in enumerate(AMINO_ACIDS)}
+TRANSITIONS = [("M", "M"), ("M", "I"), ("M", "D"),
+               ("I", "M"), ("I", "I"), ("I", "D"),
+               ("D", "M"), ("D", "I"), ("D", "D")]
+TRANS_INDEX = {trans: i for i, trans in enumerate(TRANSITIONS)}
+
 
 # Function definitions
 def parse_file(filename):
@@ -306,6 +316,188 @@ def create_hmm_seq(mat_em, ins_em, trans_dict):
     return "".join(seq)
 
 
+def log_odds_model(mat_em, ins_em, trans_dict, dtype=np.float32,
+                   prior_weight=0.0):
+    """Convert a trained HMM to log-space arrays for scoring.
+
+    Emissions are stored as log-odds against the background probabilities
+    (pa), transitions as natural log probabilities. Impossible events become
+    -inf. float32 halves the memory footprint of the model compared to
+    float64, which is enough for the additive Viterbi recurrence.
+
+    With a prior_weight, the probabilities of every state are normalised and
+    mixed with a prior: the background for emissions and equal chances for
+    the three transitions out of a state. Residues and transitions that do
+    not occur in the alignment then keep a small probability instead of
+    -inf, so unrelated sequences still get a finite score.
+
+    :param mat_em: list of dicts of the match state emission probabilities.
+    :param ins_em: dict of the insertion state emission probability.
+    :param trans_dict: dict containing the transition probabilities.
+    :param dtype: numpy float type used to store the arrays.
+    :param prior_weight: weight of the prior, between 0 (only the alignment)
+    and 1 (only the prior).
+    :return: dict with "match" (n_matches x 20), "insert" (20) and "trans"
+    (9 x n_matches + 1) arrays, ordered by AMINO_ACIDS and TRANSITIONS.
+    """
+    background = np.array([pa[aa] for aa in AMINO_ACIDS])
+    match = np.array([[state.get(aa, 0.0) for aa in AMINO_ACIDS]
+                      for state in mat_em], dtype=np.float64)
+    match = match.reshape(len(mat_em), len(AMINO_ACIDS))
+    insert = np.array([ins_em.get(aa, 0.0) for aa in AMINO_ACIDS])
+    trans = np.array([trans_dict[key] for key in TRANSITIONS],
+                     dtype=np.float64)
+    if prior_weight:
+        states = [(match, background), (insert, background),
+                  # TRANSITIONS is grouped by the state they leave.
+                  (trans.reshape(3, 3, -1), np.full((1, 3, 1), 1 / 3))]
+        for n, (probs, prior) in enumerate(states):
+            axis = 1 if probs.ndim == 3 else -1
+            totals = probs.sum(axis=axis, keepdims=True)
+            # States without observations get the prior alone.
+            probs = np.where(totals > 0, probs / np.where(totals > 0, totals,
+                                                          1), prior)
+            states[n] = (1 - prior_weight) * probs + prior_weight * prior
+        match, insert = states[0], states[1]
+        trans = states[2].reshape(len(TRANSITIONS), -1)
+
+    with np.errstate(divide="ignore"):
+        return {"match": np.log(match / background).astype(dtype),
+                "insert": np.log(insert / background).astype(dtype),
+                "trans": np.log(trans).astype(dtype)}
+
+
+def encode_sequence(seq):
+    """Translate a sequence to an array of indices in AMINO_ACIDS.
+
+    :param seq: string, (unaligned) protein sequence.
+    :return: numpy array of residue indices.
+    """
+    try:
+        return np.array([AA_INDEX[aa] for aa in seq.upper()], dtype=np.intp)
+    except KeyError as error:
+        raise ValueError("Unknown residue {0} in sequence.".format(error))
+
+
+def _prefix_chain(start, step, combine):
+    """Solve the insert state chain I[i] = combine(start[i], I[i-1] + step[i]).
+
+    The chain is rewritten as a prefix scan over start - cumsum(step) so a
+    whole row of the DP is computed without a Python loop over the sequence.
+    Accumulation is done in float64, independent of the model dtype.
+
+    :param start: array, score of entering the insert state at each position.
+    :param step: array, score of staying in the insert state at each position.
+    :param combine: numpy ufunc, np.maximum (Viterbi) or np.logaddexp
+    (forward).
+    :return: array with the insert state scores of the row.
+    """
+    step = step.astype(np.float64)
+    if np.isneginf(step).all():
+        # Staying in the insert state is impossible, so no chain exists.
+        return start
+    if np.isneginf(step).any():
+        # Impossible residues break the scan, fall back to a plain loop.
+        chain = start.copy()
+        for i in range(1, len(chain)):
+            chain[i] = combine(chain[i], chain[i - 1] + step[i])
+        return chain
+    offset = np.cumsum(step)
+    return (combine.accumulate(start.astype(np.float64) - offset) +
+            offset).astype(start.dtype)
+
+
+def _profile_dp(seq, log_model, combine):
+    """Run the profile HMM recurrence row by row (one row per match state).
+
+    :param seq: string, sequence to score.
+    :param log_model: dict of arrays made by log_odds_model().
+    :param combine: numpy ufunc, np.maximum (Viterbi) or np.logaddexp
+    (forward).
+    :return: float, the score of the sequence against the model.
+    """
+    codes = encode_sequence(seq)
+    match, insert, trans = log_model["match"], log_model["insert"], \
+        log_model["trans"]
+    dtype = np.float64 if combine is np.logaddexp else match.dtype
+    t = {key: trans[TRANS_INDEX[key]].astype(dtype) for key in TRANSITIONS}
+    ins_row = insert[codes].astype(dtype)
+    neg_inf = np.full(len(codes) + 1, -np.inf, dtype=dtype)
+
+    # Row 0: begin state (M0) and the insert state before the first match.
+    mat = neg_inf.copy()
+    mat[0] = 0.0
+    dele = neg_inf.copy()
+    ins = neg_inf.copy()
+    ins[1:] = _prefix_chain(ins_row + mat[:-1] + t[("M", "I")][0],
+                            ins_row + t[("I", "I")][0], combine)
+
+    for j in range(1, len(match) + 1):
+        prev_mat, prev_ins, prev_del = mat, ins, dele
+        mat = neg_inf.copy()
+        mat[1:] = match[j - 1][codes] + \
+            combine(combine(prev_mat[:-1] + t[("M", "M")][j - 1],
+                            prev_ins[:-1] + t[("I", "M")][j - 1]),
+                    prev_del[:-1] + t[("D", "M")][j - 1])
+        dele = combine(combine(prev_mat + t[("M", "D")][j - 1],
+                               prev_ins + t[("I", "D")][j - 1]),
+                       prev_del + t[("D", "D")][j - 1])
+        ins = neg_inf.copy()
+        ins[1:] = _prefix_chain(
+            ins_row + combine(mat[:-1] + t[("M", "I")][j],
+                              dele[:-1] + t[("D", "I")][j]),
+            ins_row + t[("I", "I")][j], combine)
+
+    n = len(match)
+    end = combine(combine(mat[-1] + t[("M", "M")][n],
+                          ins[-1] + t[("I", "M")][n]),
+                  dele[-1] + t[("D", "M")][n])
+    return float(end)
+
+
+def viterbi_score(seq, log_model):
+    """Calculate the log-odds score of the most likely path of a sequence.
+
+    :param seq: string, sequence to score.
+    :param log_model: dict of arrays made by log_odds_model().
+    :return: float, Viterbi log-odds score (-inf if the sequence cannot be
+    emitted by the model).
+    """
+    return _profile_dp(seq, log_model, np.maximum)
+
+
+def forward_score(seq, log_model):
+    """Calculate the log-odds score of a sequence summed over all paths.
+
+    Summing probabilities does not survive float32 over long models, so the
+    forward variables are always kept in float64 log-space.
+
+    :param seq: string, sequence to score.
+    :param log_model: dict of arrays made by log_odds_model().
+    :return: float, forward log-odds score.
+    """
+    return _profile_dp(seq, log_model, np.logaddexp)
+
+
+def max_precision_error(sequences, log_model, reference_model):
+    """Check the Viterbi scores of a model against a float64 reference.
+
+    :param sequences: iterable of strings, sequences to score.
+    :param log_model: dict of (float32) arrays made by log_odds_model().
+    :param reference_model: dict of float64 arrays made by log_odds_model().
+    :return: float, the largest relative difference between both scores.
+    """
+    max_error = 0.0
+    for seq in sequences:
+        fast = viterbi_score(seq, log_model)
+        reference = viterbi_score(seq, reference_model)
+        if fast == reference:
+            continue
+        max_error = max(max_error,
+                        abs(fast - reference) / max(1.0, abs(reference)))
+    return max_error
+
+
 def main():
     """Main code."""
 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Author: Matthijs Pon
+Date: 2026-10-19
+
+Description: benchmark the phases of hidden_markov_models.py (training,
+sequence generation and scoring) on synthetic alignments. For every phase the
+wall time and peak (Python) memory are reported as JSON, optionally with a
+cProfile dump per phase.
+Usage: python3 hmm_benchmark.py [--depth N ...] [--width N ...] [options]
+"""
+# Import statements
+import argparse
+import cProfile
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import hidden_markov_models as hmm
+
+
+# Function definitions
+def synthetic_alignment(filename, depth, width, gap_rate=0.1,
+                        mutation_rate=0.2, seed=0):
+    """Write a random alignment of depth sequences by width columns.
+
+    Every sequence is derived from one random core sequence, so the alignment
+    has realistic match and insert columns.
+
+    :param filename: name of the fasta file to write to.
+    :param depth: number of sequences in the alignment.
+    :param width: number of columns in the alignment.
+    :param gap_rate: chance of a gap at each position.
+    :param mutation_rate: chance of a substitution at each position.
+    :param seed: seed for the random generator.
+    :return: no return. The alignment is written to filename.
+    """
+    rng = random.Random(seed)
+    residues = hmm.AMINO_ACIDS
+    core = [rng.choice(residues) for i in range(width)]
+
+    with open(filename, "w") as file:
+        for n in range(depth):
+            seq = []
+            for char in core:
+                pick = rng.random()
+                if pick < gap_rate:
+                    seq.append("-")
+                elif pick < gap_rate + mutation_rate:
+                    seq.append(rng.choice(residues))
+                else:
+                    seq.append(char)
+            file.write(">seq{0}\n{1}\n".format(n, "".join(seq)))
+
+
+def run_phase(name, function, profile_dir=None, label=""):
+    """Time a single phase and measure its peak memory.
+
+    The phase is run separately for each measurement, so neither tracemalloc
+    nor cProfile slows down the timed run: once for the wall time, once
+    traced for the peak memory and once more for the profile if requested.
+
+    :param name: name of the phase.
+    :param function: function without arguments which runs the phase.
+    :param profile_dir: directory for cProfile dumps, None disables profiling.
+    :param label: prefix for the name of the profile dump.
+    :return: the return value of the timed run of function and a dict with
+    the measurements.
+    """
+    start = time.perf_counter()
+    result = function()
+    wall_time = time.perf_counter() - start
+
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stats = {"phase": name, "wall_time": wall_time, "peak_memory": peak}
+    if profile_dir:
+        profiler = cProfile.Profile()
+        profiler.runcall(function)
+        dump = os.path.join(profile_dir, "{0}{1}.prof".format(label, name))
+        profiler.dump_stats(dump)
+        stats["profile"] = dump
+    return result, stats
+
+
+def benchmark(depth, width, n_samples=10, n_scores=10, profile_dir=None,
+              seed=0):
+    """Benchmark all phases of the HMM pipeline on one synthetic alignment.
+
+    :param depth: number of sequences in the alignment.
+    :param width: number of columns in the alignment.
+    :param n_samples: number of sequences to generate with the model.
+    :param n_scores: number of generated sequences to score.
+    :param profile_dir: directory for cProfile dumps, None disables profiling.
+    :param seed: seed for the random generators.
+    :return: a dict with the settings and the measurements of each phase.
+    """
+    random.seed(seed)
+    label = "d{0}_w{1}_".format(depth, width)
+    phases = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "alignment.fasta")
+        synthetic_alignment(filename, depth, width, seed=seed)
+
+        model, stats = run_phase("train_hmm",
+                                 lambda: hmm.train_hmm(filename),
+                                 profile_dir, label)
+        phases.append(stats)
+
+    mat_em, ins_em, trans_dict = model
+    seqs, stats = run_phase(
+        "create_hmm_seq",
+        lambda: [hmm.create_hmm_seq(mat_em, ins_em, trans_dict)
+                 for i in range(n_samples)], profile_dir, label)
+    phases.append(stats)
+
+    log_model, stats = run_phase(
+        "log_odds_model",
+        lambda: hmm.log_odds_model(mat_em, ins_em, trans_dict),
+        profile_dir, label)
+    phases.append(stats)
+
+    for name, score in (("viterbi_score", hmm.viterbi_score),
+                        ("forward_score", hmm.forward_score)):
+        stats = run_phase(name,
+                          lambda: [score(seq, log_model)
+                                   for seq in seqs[:n_scores]],
+                          profile_dir, label)[1]
+        phases.append(stats)
+
+    return {"depth": depth, "width": width, "n_matches": len(mat_em),
+            "n_samples": n_samples, "n_scores": min(n_scores, len(seqs)),
+            "phases": phases}
+
+
+def parse_arguments():
+    """Parse the command line arguments.
+
+    :return: argparse namespace with the arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark training, sampling and scoring of "
+                    "hidden_markov_models.py on synthetic alignments.")
+    parser.add_argument("--depth", type=int, nargs="+", default=[1000],
+                        help="number(s) of sequences in the alignment")
+    parser.add_argument("--width", type=int, nargs="+", default=[100],
+                        help="number(s) of columns in the alignment")
+    parser.add_argument("--samples", type=int, default=10,
+                        help="number of sequences to generate")
+    parser.add_argument("--scores", type=int, default=10,
+                        help="number of generated sequences to score")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile-dir",
+                        help="write a cProfile dump per phase to this "
+                             "directory")
+    parser.add_argument("--output", help="write the JSON report to this file "
+                                         "instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    """Main code."""
+    args = parse_arguments()
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+
+    results = []
+    for depth in args.depth:
+        for width in args.width:
+            results.append(benchmark(depth, width, args.samples, args.scores,
+                                     args.profile_dir, args.seed))
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
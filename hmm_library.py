@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Author: Matthijs Pon
+Date: 2026-10-19
+
+Description: build a library of profile HMMs from a directory of family
+alignments and score sequences against every model in it (like hmmscan).
+The models are trained in parallel with hidden_markov_models.py and packed
+into one file: a header with a JSON index of the models and their offsets,
+followed by the log-space arrays of every model. A scan memory-maps the
+library once and uses the arrays in place, without loading models one by one.
+The models are mixed with a prior (PRIOR_WEIGHT, see log_odds_model()), so a
+residue a family never has does not give every other family a score of -inf.
+Usage: python3 hmm_library.py build <alignment_dir> <library> [options]
+       python3 hmm_library.py scan <library> <queries.fasta> [options]
+"""
+# Import statements
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+import hidden_markov_models as hmm
+
+# Start of every library file, followed by the length of the JSON index.
+MAGIC = b"HMMLIB01"
+# Blocks start at multiples of this many bytes, so the arrays stay aligned.
+ALIGNMENT = 64
+DTYPE = np.dtype("<f4")
+N_RESIDUES = len(hmm.AMINO_ACIDS)
+N_TRANSITIONS = len(hmm.TRANSITIONS)
+SCORES = {"viterbi": hmm.viterbi_score, "forward": hmm.forward_score}
+# Weight of the prior mixed into the library models, like a pseudocount.
+PRIOR_WEIGHT = 0.05
+
+
+# Function definitions
+def padding(size):
+    """Return the number of bytes needed to pad size to ALIGNMENT.
+
+    :param size: int, number of bytes.
+    :return: int, number of padding bytes.
+    """
+    return -size % ALIGNMENT
+
+
+def train_model(filename, prior_weight=PRIOR_WEIGHT):
+    """Train a model on one alignment and convert it to log-space arrays.
+
+    :param filename: name of the alignment (fasta) file.
+    :param prior_weight: weight of the prior, see log_odds_model().
+    :return: the name of the model (file name without extension) and the dict
+    made by log_odds_model(), or None instead of the dict if the alignment
+    could not be used.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    try:
+        mat_em, ins_em, trans_dict = hmm.train_hmm(filename)
+    except (IndexError, KeyError, ValueError, ZeroDivisionError) as error:
+        print("Skipping {0}: {1!r}".format(filename, error), file=sys.stderr)
+        return name, None
+    return name, hmm.log_odds_model(mat_em, ins_em, trans_dict, dtype=DTYPE,
+                                    prior_weight=prior_weight)
+
+
+def model_size(n_matches):
+    """Return the number of bytes of the arrays of one model.
+
+    :param n_matches: int, number of match states of the model.
+    :return: int, size of the match, insert and transition arrays in bytes.
+    """
+    return (n_matches * N_RESIDUES + N_RESIDUES +
+            N_TRANSITIONS * (n_matches + 1)) * DTYPE.itemsize
+
+
+def build_library(alignment_dir, library_file, workers=None,
+                  extensions=(".fasta", ".fa", ".afa"),
+                  prior_weight=PRIOR_WEIGHT):
+    """Train a model for every alignment in a directory and pack them.
+
+    The models are trained in a process pool. The library is written to a
+    temporary file first, so an interrupted build leaves no broken library.
+
+    :param alignment_dir: directory with one alignment per family.
+    :param library_file: name of the library file to write.
+    :param workers: number of processes, None uses all cores.
+    :param extensions: file extensions of the alignments.
+    :param prior_weight: weight of the prior mixed into every model, 0 keeps
+    the plain alignment probabilities.
+    :return: the number of models in the library.
+    """
+    filenames = sorted(os.path.join(alignment_dir, name)
+                       for name in os.listdir(alignment_dir)
+                       if name.endswith(tuple(extensions)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        models = [(name, model) for name, model in
+                  pool.map(partial(train_model, prior_weight=prior_weight),
+                           filenames, chunksize=4)
+                  if model is not None]
+
+    # Index with the byte offset of every model relative to the data start.
+    index = {"dtype": DTYPE.str, "prior_weight": prior_weight,
+             "models": []}
+    offset = 0
+    for name, model in models:
+        n_matches = len(model["match"])
+        index["models"].append({"name": name, "n_matches": n_matches,
+                                "offset": offset})
+        offset += model_size(n_matches)
+        offset += padding(offset)
+
+    header = json.dumps(index).encode()
+    header_size = len(MAGIC) + 8 + len(header)
+    with open(library_file + ".part", "wb") as file:
+        file.write(MAGIC)
+        file.write(len(header).to_bytes(8, "little"))
+        file.write(header)
+        file.write(bytes(padding(header_size)))
+        for name, model in models:
+            size = 0
+            for part in ("match", "insert", "trans"):
+                data = np.ascontiguousarray(model[part], dtype=DTYPE)
+                file.write(data.tobytes())
+                size += data.nbytes
+            file.write(bytes(padding(size)))
+    os.replace(library_file + ".part", library_file)
+    return len(models)
+
+
+def open_library(library_file):
+    """Memory-map a library and make the models available without copies.
+
+    :param library_file: name of the library file.
+    :return: list of tuples, (model name, dict of arrays as made by
+    log_odds_model()). The arrays are read-only views on the mapped file.
+    """
+    data = np.memmap(library_file, dtype=np.uint8, mode="r")
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError("{0} is not a HMM library.".format(library_file))
+    header_length = int.from_bytes(bytes(data[len(MAGIC):len(MAGIC) + 8]),
+                                   "little")
+    header_size = len(MAGIC) + 8 + header_length
+    index = json.loads(bytes(data[len(MAGIC) + 8:header_size]))
+    dtype = np.dtype(index["dtype"])
+    start = header_size + padding(header_size)
+
+    models = []
+    for entry in index["models"]:
+        n = entry["n_matches"]
+        block = data[start + entry["offset"]:
+                     start + entry["offset"] + model_size(n)].view(dtype)
+        models.append((entry["name"], {
+            "match": block[:n * N_RESIDUES].reshape(n, N_RESIDUES),
+            "insert": block[n * N_RESIDUES:(n + 1) * N_RESIDUES],
+            "trans": block[(n + 1) * N_RESIDUES:].reshape(N_TRANSITIONS,
+                                                          n + 1)}))
+    return models
+
+
+_SCAN_STATE = {}
+
+
+def _scan_init(library_file, algorithm):
+    """Set up a worker process for scan_library().
+
+    Every worker maps the library itself, the operating system shares the
+    pages between them.
+
+    :param library_file: name of the library file.
+    :param algorithm: key of SCORES, the scoring function to use.
+    :return: no return. The state is stored in _SCAN_STATE.
+    """
+    _SCAN_STATE.update(models=open_library(library_file),
+                       score=SCORES[algorithm])
+
+
+def _scan_query(query):
+    """Score one query against every model in a worker process.
+
+    :param query: tuple of (name, sequence).
+    :return: list of tuples, (query name, model name, score), or an empty
+    list if the sequence contains unknown residues.
+    """
+    name, seq = query
+    try:
+        hmm.encode_sequence(seq)
+    except ValueError as error:
+        print("Skipping {0}: {1}".format(name, error), file=sys.stderr)
+        return []
+    return [(name, model_name, _SCAN_STATE["score"](seq, model))
+            for model_name, model in _SCAN_STATE["models"]]
+
+
+def scan_library(library_file, queries, algorithm="viterbi", workers=None):
+    """Score every query sequence against every model in a library.
+
+    :param library_file: name of the library file.
+    :param queries: list of tuples, (name, sequence).
+    :param algorithm: "viterbi" or "forward".
+    :param workers: number of processes, None uses all cores.
+    :return: generator of lists of (query name, model name, score), one list
+    per query in the order of queries.
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_scan_init,
+                             initargs=(library_file, algorithm)) as pool:
+        yield from pool.map(_scan_query, queries)
+
+
+def parse_arguments():
+    """Parse the command line arguments.
+
+    :return: argparse namespace with the arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Build a library of profile HMMs and scan sequences "
+                    "against it.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="train and pack a model for "
+                                              "every alignment in a "
+                                              "directory")
+    build.add_argument("alignment_dir")
+    build.add_argument("library")
+    build.add_argument("--workers", type=int,
+                       help="number of processes (default: all cores)")
+    build.add_argument("--prior-weight", type=float, default=PRIOR_WEIGHT,
+                       help="weight of the prior mixed into the models, so "
+                            "unseen residues do not score -inf (default: "
+                            "{0})".format(PRIOR_WEIGHT))
+
+    scan = commands.add_parser("scan", help="score sequences against every "
+                                            "model in a library")
+    scan.add_argument("library")
+    scan.add_argument("queries", help="fasta file with query sequences")
+    scan.add_argument("--algorithm", choices=sorted(SCORES),
+                      default="viterbi")
+    scan.add_argument("--top", type=int,
+                      help="only report the best N models per query")
+    scan.add_argument("--workers", type=int,
+                      help="number of processes (default: all cores)")
+    scan.add_argument("--output", help="write the hits to this file instead "
+                                       "of stdout")
+    return parser.parse_args()
+
+
+def main():
+    """Main code."""
+    args = parse_arguments()
+    if args.command == "build":
+        n_models = build_library(args.alignment_dir, args.library,
+                                 args.workers,
+                                 prior_weight=args.prior_weight)
+        print("Packed {0} models into {1}".format(n_models, args.library))
+        return
+
+    queries = [(name, seq.replace("-", "").replace(".", ""))
+               for name, seq in hmm.parse_file(args.queries).items()]
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        output.write("query\tmodel\tscore\n")
+        for hits in scan_library(args.library, queries, args.algorithm,
+                                 args.workers):
+            hits.sort(key=lambda hit: -hit[2])
+            for query, model, score in hits[:args.top]:
+                output.write("{0}\t{1}\t{2:.3f}\n".format(query, model,
+                                                          score))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ Description: a script for the alignment of two protein sequences.
 # import statements here
 import math
 
+import numpy as np
+
 # functions between here and __main__
 blosum = """
 # http://www.ncbi.nlm.nih.gov/Class/FieldGuide/BLOSUM62.txt
@@ -320,6 +322,117 @@ def align_sequences(seq1, seq2, gap_pen=0, end_gap_pen=0):
     return aligned_seq, perc_id, max_score
 
 
+def align_batch(query, targets, gap_pen=0, end_gap_pen=0, tracebacks=False,
+                batch_size=256):
+    """Aligns one query against many targets, giving the same results as
+    align_sequences(query, target) for every target.
+
+    The targets are sorted on length and aligned in batches. For every row of
+    the query the recurrence of score_cell is applied to a whole batch at
+    once, with the targets on the first axis of a 2-D NumPy array. The
+    horizontal (side) dependency within a row is a running maximum.
+
+    :param query: the query sequence (seq1 of align_sequences).
+    :param targets: list of target sequences (seq2 of align_sequences).
+    :param gap_pen: penalty for creating a gap (an integer).
+    :param end_gap_pen: penalty for creating an end-gap (an integer).
+    :param tracebacks: also return the alignments of every target.
+    :param batch_size: maximum number of targets aligned at once.
+    :return: a list with the alignment score of every target, or when
+    tracebacks is True a list with for every target the tuple
+    align_sequences returns (aligned strings, percentage identity, score).
+    When no cell of the last column beats row 0, align_sequences raises a
+    TypeError; align_batch then returns that alignment, with the whole
+    target before the query.
+    """
+    if gap_pen != int(gap_pen) or end_gap_pen != int(end_gap_pen):
+        raise ValueError("align_batch needs integer gap penalties")
+    gap_pen = int(gap_pen)
+    end_gap_pen = int(end_gap_pen)
+    blosum_array = np.array(BLOSUM62_MATRIX, dtype=np.int64)
+    query_codes = [BLOSUM62_ORDER[res] for res in query]
+    n_rows = len(query)
+    order = sorted(range(len(targets)), key=lambda t: len(targets[t]))
+    results = [None] * len(targets)
+
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        lengths = np.array([len(targets[t]) for t in batch])
+        n_columns = lengths.max() + 1
+        # Positions behind the end of a shorter target are padded, they do
+        # not influence the positions before them.
+        codes = np.zeros((len(batch), n_columns - 1), dtype=np.intp)
+        for row, t in enumerate(batch):
+            codes[row, :lengths[row]] = [BLOSUM62_ORDER[res]
+                                         for res in targets[t]]
+        columns = np.arange(n_columns)
+        rows = np.arange(len(batch))
+        # a top move into the last column of a target is an end-gap.
+        top_pen = np.where(columns[1:] == lengths[:, None], end_gap_pen,
+                           gap_pen)
+
+        previous = np.tile(-columns * end_gap_pen, (len(batch), 1))
+        best_score = previous[rows, lengths]
+        best_i = np.zeros(len(batch), dtype=np.intp)
+        if tracebacks:
+            moves = np.empty((n_rows + 1, len(batch), n_columns),
+                             dtype=np.int8)
+            moves[0] = 2
+            moves[0, :, 0] = 0
+            moves[1:, :, 0] = 3
+
+        for i in range(1, n_rows + 1):
+            side_pen = gap_pen if i < n_rows else end_gap_pen
+            diagonal = previous[:, :-1] + blosum_array[query_codes[i - 1],
+                                                       codes]
+            best_parent = np.maximum(diagonal, previous[:, 1:] - top_pen)
+            # current[j] = max(best_parent[j], current[j - 1] - side_pen)
+            offset = columns * side_pen
+            current = np.empty_like(previous)
+            current[:, 0] = -i * end_gap_pen
+            current[:, 1:] = best_parent
+            current = np.maximum.accumulate(current + offset, axis=1) - offset
+            if tracebacks:
+                # same order as score_cell: diagonal, side, top.
+                cells = current[:, 1:]
+                moves[i, :, 1:] = np.where(
+                    cells == diagonal, 1,
+                    np.where(cells == current[:, :-1] - side_pen, 2, 3))
+
+            # max_score_matrix keeps the first maximum of the last column.
+            last_column = current[rows, lengths]
+            better = last_column > best_score
+            best_score = np.where(better, last_column, best_score)
+            best_i = np.where(better, i, best_i)
+            previous = current
+
+        for row, t in enumerate(batch):
+            if not tracebacks:
+                results[t] = int(best_score[row])
+                continue
+            if best_i[row] == 0:
+                # the best end is in row 0: the target is aligned to gaps
+                # in front of the query, which string_alignment can't show.
+                length = int(lengths[row])
+                aligned_seq = ("-" * length + query,
+                               targets[t] + "-" * n_rows,
+                               " " * (length + n_rows))
+                results[t] = (aligned_seq, 0.0, int(best_score[row]))
+                continue
+            # translate the moves to the traceback matrix of score_matrix.
+            steps = ((0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1))
+            traceback_matrix = [[steps[move] for move in line] for line in
+                                moves[:, row, :lengths[row] + 1].tolist()]
+            traceback_path = traceback_alignment(int(best_i[row]),
+                                                 int(lengths[row]),
+                                                 traceback_matrix)
+            aligned_seq = string_alignment(traceback_path, query, targets[t])
+            perc_id = calc_perc_identity(aligned_seq[0], aligned_seq[1])
+            results[t] = (aligned_seq, perc_id, int(best_score[row]))
+
+    return results
+
+
 def print_seqs(sequence_tuple):
     """Prints the sequences in an neat way.
 
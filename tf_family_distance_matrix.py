@@ -5,160 +5,1800 @@ Date: 2020-11-19
 Description: Calculate the average alignment distance between protein families
              using blastp and write them to a comma-separated file.
 Usage: python3 tf_family_distance_matrix.py <input.fasta> <output.csv>
+                                            [--metrics METRIC ...]
+                                            [--backend blast|native]
+                                            [--format FORMAT]
+                                            [--tree upgma|nj]
+                                            [--shards N] [--workers N]
+                                            [--cache FILE | --no-cache]
+                                            [--dbsize N]
+                                            [--stream [--keep-tsv]]
+                                            [--symmetric [--reciprocal R]]
     input.fasta: name of the input fasta file
     output.csv: name of file to output to
+    --metrics: family metrics to write (default: length), see METRICS;
+               several metrics are written to <output>_<metric>.csv
+    --backend: blast (default) or native, an in-process k-mer prefilter and
+               local alignment which needs no external tools
+    --format: csv (default), sparse (row/column/value tsv, families in
+              <output>.families), npy, npz or columns (a directory with one
+              .npy per column)
+    --tree: cluster the families with UPGMA or neighbor-joining and write a
+            Newick tree to <output>.nwk (see --tree-metric, --tree-output);
+            UPGMA takes well under a second for thousands of families, nj
+            around ten seconds for 3000 tree-like families and up to a
+            minute or more for distances without tree structure
+    --shards: number of pieces the query file is split into (default: cores)
+    --workers: number of blastp processes run at once (default: cores)
+    --cache: blastp result cache (default: <input.fasta>_blastp_cache.sqlite),
+             only new or changed sequences are searched again
+    --no-cache: reuse <input.fasta>_blastp.tsv if it exists, like before
+    --dbsize: effective database size for the e-values (default: residues
+              in the input; with the cache the size of its first search is
+              kept, so added sequences leave the cached hits valid), a new
+              size searches all sequences again
+    --stream: aggregate the blastp output through pipes while blastp runs
+              (no cache); --keep-tsv also writes <input.fasta>_blastp.tsv
+    --symmetric: search every pair of sequences once (no cache), shard i
+                 only against shards i, i + 1, ... (more --shards leave
+                 fewer pairs searched twice); writes symmetric matrices.
+                 --reciprocal mean (default), max or best sets how the hits
+                 of a pair found in both directions are combined
 """
 
-from sys import argv
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import hashlib
+import math
 import os
+import queue
+import shutil
+import sqlite3
 import subprocess
+import tempfile
+import threading
 
+import numpy as np
 
-def check_user_input():
-    """Check the input given on the command line.
+from protein_alignment import BLOSUM62_MATRIX, BLOSUM62_ORDER
 
-    output: None, function raises errors if input is incorrect.
+
+BLASTP_OPTIONS = ["-evalue", "1E-10", "-outfmt", "6", "-max_hsps", "1"]
+# Number of hits collected before they are added to the family tables.
+CHUNK_SIZE = 1000000
+# Maximum number of streamed blastp lines waiting to be aggregated.
+STREAM_QUEUE_SIZE = 100000
+# Settings of the native (in-process) search backend.
+KMER_SIZE = 3
+MIN_SHARED_KMERS = 2
+# Pairs need this many standard deviations more shared k-mers than chance.
+KMER_Z_SCORE = 4
+NATIVE_GAP_PENALTY = 8
+NATIVE_BATCH_SIZE = 256
+# Ungapped BLOSUM62 Karlin-Altschul parameters, used for native bitscores.
+BLOSUM62_LAMBDA = 0.3176
+BLOSUM62_K = 0.134
+# Family level metrics which can be calculated from the blastp hits.
+METRICS = {"length": "mean alignment length",
+           "identity": "mean percentage identity",
+           "bitscore": "mean bitscore",
+           "max_bitscore": "maximum bitscore",
+           "count": "number of hits",
+           "bitscore_distance": "1 - mean bitscore normalised by the lowest "
+                                "mean bitscore of both families to itself"}
+# Ways to combine the hits of a sequence pair found in both directions.
+RECIPROCAL_POLICIES = {"mean": "mean of both hits",
+                       "max": "highest value of both hits (lowest e-value)",
+                       "best": "the hit with the highest bitscore"}
+
+
+def parse_arguments():
+    """Parse the input given on the command line.
+
+    output: argparse namespace, function raises errors if input is incorrect.
     """
-    if len(argv) == 3:
-        return None
-    else:
-        raise ValueError("Please give two command line arguments.")
+    parser = argparse.ArgumentParser(
+        description="Calculate the average alignment distance between "
+                    "protein families using blastp.")
+    parser.add_argument("input", help="name of the input fasta file")
+    parser.add_argument("output", help="name of file to output to")
+    parser.add_argument("--metrics", nargs="+", default=["length"],
+                        choices=list(METRICS),
+                        help="family level metrics to write, several "
+                             "metrics are written to <output>_<metric>.csv")
+    parser.add_argument("--format", choices=["csv", "sparse", "npy", "npz",
+                                              "columns"], default="csv",
+                        help="output format of the family matrices")
+    parser.add_argument("--tree", choices=list(TREE_METHODS),
+                        help="cluster the families and write a Newick tree "
+                             "(nj is much slower than upgma for thousands "
+                             "of families)")
+    parser.add_argument("--tree-metric", choices=list(METRICS),
+                        help="metric the tree is based on (default: the "
+                             "first of --metrics)")
+    parser.add_argument("--tree-output",
+                        help="Newick file to write (default: "
+                             "<output without extension>.nwk)")
+    parser.add_argument("--backend", choices=["blast", "native"],
+                        default="blast",
+                        help="search with blastp, or in-process without "
+                             "external tools or intermediate files")
+    parser.add_argument("--stream", action="store_true",
+                        help="aggregate the blastp output while it is "
+                             "produced, without the cache")
+    parser.add_argument("--keep-tsv", action="store_true",
+                        help="with --stream, also write "
+                             "<input>_blastp.tsv")
+    parser.add_argument("--symmetric", action="store_true",
+                        help="search every pair of sequences once and "
+                             "write symmetric matrices (no cache)")
+    parser.add_argument("--reciprocal", choices=list(RECIPROCAL_POLICIES),
+                        default="mean",
+                        help="with --symmetric, how to combine the hits of "
+                             "a pair found in both directions")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="number of pieces the query file is split into")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of blastp processes run at once")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="number of times a failed shard is retried")
+    parser.add_argument("--cache", default=None,
+                        help="sqlite file with cached blastp results")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not use the cache, reuse an existing "
+                             "<input>_blastp.tsv instead")
+    parser.add_argument("--dbsize", type=int, default=None,
+                        help="effective database size for the blastp "
+                             "e-values (default: residues in the input, or "
+                             "the size kept in the cache); a new size "
+                             "searches all sequences again")
+    parser.add_argument("--blastp", default="blastp",
+                        help="blastp executable to use")
+    parser.add_argument("--makeblastdb", default="makeblastdb",
+                        help="makeblastdb executable to use")
+    args = parser.parse_args()
+    if args.symmetric and args.stream:
+        parser.error("--symmetric cannot be combined with --stream")
+    return args
+
+
+def read_fasta(filename):
+    """Read a fasta file into a list of records.
+
+    input:
+        filename: string, name of the fasta file
+
+    output: list of tuples, (header line, sequence) for every record, in file
+            order. Headers are kept without the ">" and trailing newline.
+    """
+    records = []
+    with open(filename) as file:
+        for line in file:
+            if line.startswith(">"):
+                records.append((line[1:].rstrip("\n"), []))
+            elif records:
+                records[-1][1].append(line.strip())
+    return [(header, "".join(seq)) for header, seq in records]
+
+
+def split_fasta(input_file, n_shards, shard_dir):
+    """Split a fasta file into shards of roughly equal amounts of residues.
+
+    input:
+        input_file: string, name of the fasta file to split
+        n_shards: int, maximum number of shards to create
+        shard_dir: string, directory to write the shards to
+
+    output: list of strings, filenames of the shards in input order
+    """
+    records = read_fasta(input_file)
+    total = sum(len(seq) for header, seq in records)
+    n_shards = max(1, min(n_shards, len(records)))
+    target = total / n_shards
+
+    shards = []
+    current = []
+    size = 0
+    for header, seq in records:
+        current.append(">{}\n{}\n".format(header, seq))
+        size += len(seq)
+        # Close the shard once it holds its share of the residues.
+        if size >= target * (len(shards) + 1) and \
+                len(shards) < n_shards - 1:
+            shards.append(current)
+            current = []
+    if current:
+        shards.append(current)
+
+    filenames = []
+    for index, shard in enumerate(shards):
+        filename = os.path.join(shard_dir, "shard_{}.fasta".format(index))
+        with open(filename, "w") as file:
+            file.writelines(shard)
+        filenames.append(filename)
+    return filenames
 
 
-def blastp(input_file, database):
+def blastp_shard(query, database, output_file, threads=1, retries=2,
+                 blastp_bin="blastp", extra_options=()):
+    """Run blastp for a single query shard, retrying it when it fails.
+
+    input:
+        query: string, name of the fasta file with the query sequences
+        database: string, name of the (indexed) database
+        output_file: string, name of the outfmt 6 file to write to
+        threads: int, value for -num_threads
+        retries: int, number of times a failed run is retried
+        blastp_bin: string, blastp executable to use
+        extra_options: list of strings, options added to BLASTP_OPTIONS
+
+    output: string, output_file, function raises the last error if all
+            attempts fail
+    """
+    command = [blastp_bin] + BLASTP_OPTIONS + list(extra_options) + \
+        ["-num_threads", str(threads), "-db", database, "-query", query,
+         "-out", output_file + ".part"]
+    for attempt in range(retries + 1):
+        try:
+            subprocess.check_call(command)
+        except (subprocess.CalledProcessError, OSError):
+            if attempt == retries:
+                raise
+        else:
+            # Only a finished run ends up under the final name.
+            os.replace(output_file + ".part", output_file)
+            return output_file
+
+
+def blastp(input_file, database, output_file=None, shards=None, workers=None,
+           retries=2, blastp_bin="blastp", makeblastdb_bin="makeblastdb",
+           dbsize=None):
     """Run blastp using an input fasta file and a database file.
 
+    The input is split into shards which are searched concurrently, after
+    which the per-shard results are merged in input order.
+
     input:
         input_file: string, name of file to blast against db
         database: string, name of file to be used as db, will be indexed if
                   the index cannot be found
+        output_file: string, name of the merged outfmt 6 file, defaults to
+                     <input_file>_blastp.tsv
+        shards: int, number of query shards, defaults to the number of cores
+        workers: int, number of concurrent blastp runs, defaults to the
+                 number of cores
+        retries: int, number of times a failed shard is retried
+        blastp_bin: string, blastp executable to use
+        makeblastdb_bin: string, makeblastdb executable to use
+        dbsize: int, effective database size for the e-values, defaults to
+                the size of the database
 
     output: None, function raises errors
     """
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    shards = shards or cores
+    if output_file is None:
+        output_file = input_file + "_blastp.tsv"
+
     # Check if DB is indexed, otherwise index it.
     if not os.path.exists(database + ".phr"):
-        subprocess.check_call("makeblastdb -in {} -dbtype prot"
-                              "".format(database), shell=True)
-
-    # Run blastp
-    subprocess.check_call("blastp -evalue 1E-10 -outfmt 6 -max_hsps 1 "
-                          "-db {database} -out {input}_blastp.tsv "
-                          "-query {input}"
-                          "".format(input=input_file, database=database),
-                          shell=True)
+        subprocess.check_call([makeblastdb_bin, "-in", database, "-dbtype",
+                               "prot"])
+
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(
+        os.path.abspath(output_file)), prefix=".blastp_shards_")
+    try:
+        queries = split_fasta(input_file, shards, shard_dir)
+        threads = max(1, cores // min(workers, len(queries)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(blastp_shard, query, database,
+                                query + ".tsv", threads, retries, blastp_bin,
+                                ["-dbsize", str(dbsize)] if dbsize else [])
+                    for query in queries]
+            results = [job.result() for job in jobs]
+
+        # Merge the shards in input order.
+        with open(output_file + ".part", "wb") as merged:
+            for result in results:
+                with open(result, "rb") as file:
+                    shutil.copyfileobj(file, merged)
+        os.replace(output_file + ".part", output_file)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
     return None
 
 
+def blastp_symmetric(input_file, output_file=None, shards=None, workers=None,
+                     retries=2, blastp_bin="blastp",
+                     makeblastdb_bin="makeblastdb", dbsize=None):
+    """Run blastp all-vs-all, only searching the upper triangle of shards.
+
+    The input is split into shards, and shard a is only searched against
+    shards a, a + 1, ... so every pair of sequences in different shards is
+    searched in one direction. Pairs within a shard are found in both
+    directions. The effective database size is fixed to the whole input, so
+    the e-values are the same as in a full search.
+
+    input:
+        input_file: string, name of the fasta file to blast against itself
+        output_file: string, name of the merged outfmt 6 file, defaults to
+                     <input_file>_blastp_symmetric.tsv
+        shards: int, number of query shards, defaults to the number of cores
+        workers: int, number of concurrent blastp runs, defaults to the
+                 number of cores
+        retries: int, number of times a failed shard is retried
+        blastp_bin: string, blastp executable to use
+        makeblastdb_bin: string, makeblastdb executable to use
+        dbsize: int, effective database size for the e-values, defaults to
+                the residues in the input
+
+    output: dict, sequence identifier: index of its shard, to tell which
+            pairs were searched in both directions
+    """
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    shards = shards or cores
+    if output_file is None:
+        output_file = input_file + "_blastp_symmetric.tsv"
+    db_size = dbsize or sum(len(seq) for header, seq in
+                            read_fasta(input_file))
+
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(
+        os.path.abspath(output_file)), prefix=".blastp_shards_")
+    try:
+        queries = split_fasta(input_file, shards, shard_dir)
+        blocks = {}
+        for index, query in enumerate(queries):
+            for header, seq in read_fasta(query):
+                blocks[header.split()[0]] = index
+
+        # Database a holds shard a and all shards after it.
+        databases = []
+        for index in range(len(queries)):
+            database = os.path.join(shard_dir, "suffix_{}.fasta".format(index))
+            with open(database, "wb") as merged:
+                for query in queries[index:]:
+                    with open(query, "rb") as file:
+                        shutil.copyfileobj(file, merged)
+            databases.append(database)
+
+        threads = max(1, cores // min(workers, len(queries)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda database: subprocess.check_call(
+                [makeblastdb_bin, "-in", database, "-dbtype", "prot"],
+                stdout=subprocess.DEVNULL), databases))
+            jobs = [pool.submit(blastp_shard, query, database,
+                                query + ".tsv", threads, retries, blastp_bin,
+                                ["-dbsize", str(db_size)])
+                    for query, database in zip(queries, databases)]
+            results = [job.result() for job in jobs]
+
+        # Merge the shards in input order.
+        with open(output_file + ".part", "wb") as merged:
+            for result in results:
+                with open(result, "rb") as file:
+                    shutil.copyfileobj(file, merged)
+        os.replace(output_file + ".part", output_file)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    return blocks
+
+
+def blastp_stream(input_file, database, shards=None, workers=None,
+                  retries=2, blastp_bin="blastp", makeblastdb_bin="makeblastdb",
+                  tee_file=None, dbsize=None):
+    """Run blastp shards and yield their outfmt 6 lines as they arrive.
+
+    Every shard writes to a pipe which is read by its own thread, so the hits
+    can be aggregated while blastp is still running. A shard is only retried
+    when it failed before producing any output, as earlier lines have already
+    been passed on.
+
+    input:
+        input_file: string, name of file to blast against db
+        database: string, name of file to be used as db, will be indexed if
+                  the index cannot be found
+        shards: int, number of query shards, defaults to the number of cores
+        workers: int, number of concurrent blastp runs, defaults to the
+                 number of cores
+        retries: int, number of times a failed shard is retried
+        blastp_bin: string, blastp executable to use
+        makeblastdb_bin: string, makeblastdb executable to use
+        tee_file: string, if given the raw lines are also written to it
+        dbsize: int, effective database size for the e-values, defaults to
+                the size of the database
+
+    output: generator of strings, outfmt 6 lines in order of arrival
+    """
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    shards = shards or cores
+
+    # Check if DB is indexed, otherwise index it.
+    if not os.path.exists(database + ".phr"):
+        subprocess.check_call([makeblastdb_bin, "-in", database, "-dbtype",
+                               "prot"])
+
+    lines = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stop = threading.Event()
+    processes = []
+    done = object()
+
+    def put(item):
+        # Give up waiting for the consumer once the stream is closed.
+        while not stop.is_set():
+            try:
+                lines.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def run_shard(query, threads):
+        command = [blastp_bin] + BLASTP_OPTIONS + \
+            (["-dbsize", str(dbsize)] if dbsize else []) + \
+            ["-num_threads", str(threads), "-db", database, "-query", query]
+        try:
+            for attempt in range(retries + 1):
+                # Neither start nor retry a shard once the stream is closed.
+                if stop.is_set():
+                    break
+                emitted = False
+                process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                           text=True)
+                processes.append(process)
+                if stop.is_set():
+                    # Started while the running shards were being stopped.
+                    process.kill()
+                for line in process.stdout:
+                    emitted = True
+                    put(line)
+                if process.wait() == 0 or stop.is_set():
+                    break
+                if emitted or attempt == retries:
+                    raise subprocess.CalledProcessError(process.returncode,
+                                                        command)
+            put(done)
+        except Exception as error:
+            put(error)
+
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(
+        os.path.abspath(input_file)), prefix=".blastp_shards_")
+    tee = open(tee_file + ".part", "w") if tee_file else None
+    try:
+        queries = split_fasta(input_file, shards, shard_dir)
+        threads = max(1, cores // min(workers, len(queries)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for query in queries:
+                pool.submit(run_shard, query, threads)
+            try:
+                remaining = len(queries)
+                while remaining:
+                    item = lines.get()
+                    if item is done:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        if tee:
+                            tee.write(item)
+                        yield item
+            finally:
+                # Drop the shards still waiting for a worker and stop the
+                # ones that are running when the stream ends.
+                stop.set()
+                pool.shutdown(wait=False, cancel_futures=True)
+                for process in processes:
+                    if process.poll() is None:
+                        process.kill()
+        if tee:
+            tee.close()
+            os.replace(tee_file + ".part", tee_file)
+    finally:
+        if tee and not tee.closed:
+            tee.close()
+            os.remove(tee_file + ".part")
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def sequence_hash(seq):
+    """Return the content hash used to identify a sequence in the cache.
+
+    input:
+        seq: string, protein sequence
+
+    output: string, hex digest of the upper case sequence
+    """
+    return hashlib.sha1(seq.upper().encode()).hexdigest()
+
+
+def open_cache(filename):
+    """Open (and create if needed) the sqlite blastp result cache.
+
+    input:
+        filename: string, name of the sqlite file
+
+    output: sqlite3 connection
+    """
+    connection = sqlite3.connect(filename)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS hits (
+            params TEXT, query TEXT, subject TEXT, fields TEXT,
+            PRIMARY KEY (params, query, subject));
+        CREATE TABLE IF NOT EXISTS searched (
+            params TEXT, hash TEXT, PRIMARY KEY (params, hash));
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """)
+    return connection
+
+
+def write_hashed_fasta(hashes, sequences, filename):
+    """Write sequences to a fasta file using their hash as identifier.
+
+    input:
+        hashes: iterable of strings, hashes of the sequences to write
+        sequences: dict, hash: sequence
+        filename: string, name of file to write to
+
+    output: string, filename
+    """
+    with open(filename, "w") as file:
+        file.writelines(">{}\n{}\n".format(key, sequences[key])
+                        for key in hashes)
+    return filename
+
+
+def cached_blastp(input_file, cache_file, output_file=None, **blastp_args):
+    """Run blastp all-vs-all, only searching pairs missing from the cache.
+
+    Sequences are identified by their content hash, and cached hits are only
+    valid for the same blastp parameters. A sequence which is not in the
+    cache yet is searched against all current sequences, the cached
+    sequences are only searched against the new ones. Every search uses the
+    same effective database size, which is part of the parameters, so the
+    e-values of cached and new hits agree. The cache keeps the size of its
+    first search, or the last one passed as dbsize, so adding sequences
+    does not invalidate it. The hits of all current sequences are then
+    written with their current identifiers.
+
+    input:
+        input_file: string, name of the fasta file to blast against itself
+        cache_file: string, name of the sqlite cache
+        output_file: string, name of the outfmt 6 file, defaults to
+                     <input_file>_blastp.tsv
+        blastp_args: keyword arguments passed on to blastp(), dbsize
+                     defaults to the size kept in the cache, or the residues
+                     in the input on its first search
+
+    output: None, function raises errors
+    """
+    if output_file is None:
+        output_file = input_file + "_blastp.tsv"
+
+    # Map every identifier in the input to the hash of its sequence.
+    sequences = {}
+    hash_ids = {}
+    residues = 0
+    for header, seq in read_fasta(input_file):
+        key = sequence_hash(seq)
+        sequences[key] = seq
+        hash_ids.setdefault(key, []).append(header.split()[0])
+        residues += len(seq)
+
+    connection = open_cache(cache_file)
+    try:
+        # Hits searched with another database size have other e-values, so
+        # the size of the first search is kept for the later ones.
+        stored = connection.execute(
+            "SELECT value FROM meta WHERE key = 'dbsize'").fetchone()
+        dbsize = blastp_args.get("dbsize") or \
+            (int(stored[0]) if stored else residues)
+        if stored is None or int(stored[0]) != dbsize:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('dbsize', ?)",
+                    (str(dbsize),))
+        blastp_args["dbsize"] = dbsize
+        params = " ".join(BLASTP_OPTIONS + ["-dbsize", str(dbsize)])
+
+        known = {row[0] for row in connection.execute(
+            "SELECT hash FROM searched WHERE params = ?", (params,))}
+        new = [key for key in sequences if key not in known]
+        old = [key for key in sequences if key in known]
+
+        if new:
+            tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(
+                os.path.abspath(cache_file)), prefix=".blastp_cache_")
+            try:
+                new_fasta = write_hashed_fasta(
+                    new, sequences, os.path.join(tmp_dir, "new.fasta"))
+                all_fasta = write_hashed_fasta(
+                    sequences, sequences, os.path.join(tmp_dir, "all.fasta"))
+                searches = [(new_fasta, all_fasta)]
+                if old:
+                    old_fasta = write_hashed_fasta(
+                        old, sequences, os.path.join(tmp_dir, "old.fasta"))
+                    searches.append((old_fasta, new_fasta))
+
+                for query, database in searches:
+                    result = query + "_blastp.tsv"
+                    blastp(query, database, result, **blastp_args)
+                    with open(result) as file, connection:
+                        connection.executemany(
+                            "INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)",
+                            ((params,) + tuple(line.rstrip("\n").split(
+                                "\t", 2)) for line in file if line.strip()))
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+            # All pairs within the current sequences are searched now.
+            with connection:
+                connection.execute("DELETE FROM searched WHERE params = ?",
+                                   (params,))
+                connection.executemany("INSERT INTO searched VALUES (?, ?)",
+                                       ((params, key) for key in sequences))
+
+        # Write the cached hits of the current sequences to the output file.
+        with open(output_file + ".part", "w") as file:
+            for query in sequences:
+                for subject, fields in connection.execute(
+                        "SELECT subject, fields FROM hits WHERE params = ? "
+                        "AND query = ?", (params, query)):
+                    if subject not in hash_ids:
+                        continue
+                    for query_id in hash_ids[query]:
+                        file.writelines("{}\t{}\t{}\n".format(
+                            query_id, subject_id, fields)
+                            for subject_id in hash_ids[subject])
+        os.replace(output_file + ".part", output_file)
+    finally:
+        connection.close()
+    return None
+
+
+def encode_protein(seq):
+    """Translate a protein sequence to indices in the BLOSUM62 matrix.
+
+    input:
+        seq: string, protein sequence, unknown residues become X
+
+    output: array of int8, BLOSUM62 index of every residue
+    """
+    unknown = BLOSUM62_ORDER["X"]
+    return np.array([BLOSUM62_ORDER.get(res, unknown) for res in seq.upper()],
+                    dtype=np.int8)
+
+
+def kmer_codes(encoded, k=KMER_SIZE):
+    """Return the distinct k-mers of an encoded sequence as integers.
+
+    input:
+        encoded: array, output of encode_protein()
+        k: int, length of the k-mers
+
+    output: array of int64, sorted unique k-mer codes
+    """
+    if len(encoded) < k:
+        return np.zeros(0, dtype=np.int64)
+    codes = np.zeros(len(encoded) - k + 1, dtype=np.int64)
+    for offset in range(k):
+        codes = codes * len(BLOSUM62_ORDER) + \
+            encoded[offset:len(encoded) - k + 1 + offset]
+    return np.unique(codes)
+
+
+def local_align_batch(query, subjects, gap_pen=NATIVE_GAP_PENALTY):
+    """Smith-Waterman align one query against a batch of subjects at once.
+
+    The subjects are padded into a 2D array and the DP is advanced one query
+    residue (row) at a time for all subjects together. The horizontal gap
+    chain within a row is solved as a prefix maximum, which is exact for a
+    linear gap penalty. Alongside the scores the alignment length (including
+    gaps) and number of identities of the best path are tracked, packed into
+    one integer as length * 2**16 + identities, so no traceback is needed.
+
+    input:
+        query: array, encoded query sequence
+        subjects: list of arrays, encoded subject sequences
+        gap_pen: int, linear gap penalty
+
+    output: three arrays with per subject the best local alignment score,
+            the alignment length and the number of identical positions
+    """
+    n_subjects = len(subjects)
+    width = max(len(subject) for subject in subjects) + 1
+    padded = np.full((n_subjects, width - 1), BLOSUM62_ORDER["*"],
+                     dtype=np.int8)
+    for index, subject in enumerate(subjects):
+        padded[index, :len(subject)] = subject
+    blosum = np.array(BLOSUM62_MATRIX, dtype=np.int32)
+    # Penalise padding so it never takes part in a best alignment.
+    blosum[:, BLOSUM62_ORDER["*"]] = -1000
+    one = np.int32(1 << 16)
+
+    # Substitution scores and path increments per query residue.
+    profiles = {}
+    for residue in set(query.tolist()):
+        profiles[residue] = (blosum[residue][padded],
+                             one + (padded == residue).astype(np.int32))
+
+    columns = np.arange(width, dtype=np.int32)
+    gap_columns = gap_pen * columns
+    score = np.zeros((n_subjects, width), dtype=np.int32)
+    packed = np.zeros_like(score)
+    cand = np.zeros_like(score)
+    cand_packed = np.zeros_like(score)
+    best = np.zeros(n_subjects, dtype=np.int32)
+    best_packed = np.zeros_like(best)
+    subject_index = np.arange(n_subjects)
+
+    for residue in query.tolist():
+        substitution, increment = profiles[residue]
+        # Candidates from the diagonal, from above and starting anew.
+        diag = score[:, :-1] + substitution
+        up = score[:, 1:] - gap_pen
+        np.maximum(np.maximum(diag, up), 0, out=cand[:, 1:])
+        cand_packed[:, 1:] = np.where(cand[:, 1:] == diag,
+                                      packed[:, :-1] + increment,
+                                      packed[:, 1:] + one)
+        cand_packed[:, 1:][cand[:, 1:] == 0] = 0
+
+        # Horizontal gaps: score[j] = max over k <= j of cand[k] - gap*(j-k)
+        shifted = cand + gap_columns
+        running = np.maximum.accumulate(shifted, axis=1)
+        origin = np.maximum.accumulate(
+            np.where(shifted == running, columns, 0), axis=1)
+        score = running - gap_columns
+        packed = np.take_along_axis(cand_packed, origin, axis=1) + \
+            (columns - origin) * one
+
+        # Keep the first best cell of every subject.
+        row_best = score.argmax(axis=1)
+        row_score = score[subject_index, row_best]
+        better = row_score > best
+        if better.any():
+            best[better] = row_score[better]
+            best_packed[better] = packed[subject_index, row_best][better]
+
+    return best, best_packed >> 16, best_packed & 0xFFFF
+
+
+# State shared with the native search worker processes.
+_NATIVE_STATE = {}
+
+
+def _native_init(ids, encoded, gap_pen, min_shared, evalue,
+                 symmetric=False):
+    """Set up a worker process for native_hits().
+
+    input:
+        ids: list of strings, sequence identifiers
+        encoded: list of arrays, encoded sequences
+        gap_pen: int, linear gap penalty
+        min_shared: int, minimum number of shared k-mers to align a pair
+        evalue: float, maximum e-value of reported hits
+        symmetric: bool, only search subjects from the query onwards
+
+    output: None, the state is stored in _NATIVE_STATE
+    """
+    kmers = [kmer_codes(seq) for seq in encoded]
+    # Inverted index: k-mer code -> sequences containing it.
+    all_codes = np.concatenate(kmers) if kmers else np.zeros(0, np.int64)
+    owners = np.repeat(np.arange(len(kmers)), [len(k) for k in kmers])
+    order = np.argsort(all_codes, kind="stable")
+    _NATIVE_STATE.update(ids=ids, encoded=encoded, kmers=kmers,
+                         n_kmers=np.array([len(k) for k in kmers]),
+                         codes=all_codes[order], owners=owners[order],
+                         gap_pen=gap_pen, min_shared=min_shared,
+                         evalue=evalue, symmetric=symmetric,
+                         db_length=sum(len(seq) for seq in encoded))
+
+
+def _native_search(query_index):
+    """Search one query against all sequences in a worker process.
+
+    input:
+        query_index: int, index of the query in _NATIVE_STATE
+
+    output: list of tuples, (query_id, subject_id, outfmt 6 values) for
+            every hit passing the e-value cutoff
+    """
+    state = _NATIVE_STATE
+    query = state["encoded"][query_index]
+    # k-mer prefilter: count shared k-mers with every sequence.
+    start = np.searchsorted(state["codes"], state["kmers"][query_index])
+    stop = np.searchsorted(state["codes"], state["kmers"][query_index],
+                           side="right")
+    shared = np.bincount(np.concatenate(
+        [state["owners"][a:b] for a, b in zip(start, stop)] or
+        [np.zeros(0, dtype=np.int64)]), minlength=len(state["ids"]))
+    # Only keep pairs sharing clearly more k-mers than expected by chance.
+    expected = len(state["kmers"][query_index]) * state["n_kmers"] / \
+        20 ** KMER_SIZE
+    threshold = np.maximum(state["min_shared"],
+                           expected + KMER_Z_SCORE * np.sqrt(expected))
+    candidates = np.flatnonzero(shared >= threshold)
+    if state["symmetric"]:
+        # The pairs with earlier subjects are found from the other side.
+        candidates = candidates[candidates >= query_index]
+    if len(candidates) == 0 or len(query) == 0:
+        return []
+
+    hits = []
+    # Align the candidates in batches of similar length to limit padding.
+    candidates = sorted(candidates, key=lambda i: len(state["encoded"][i]))
+    for first in range(0, len(candidates), NATIVE_BATCH_SIZE):
+        batch = candidates[first:first + NATIVE_BATCH_SIZE]
+        scores, lengths, idents = local_align_batch(
+            query, [state["encoded"][i] for i in batch], state["gap_pen"])
+        bits = (BLOSUM62_LAMBDA * scores - math.log(BLOSUM62_K)) / \
+            math.log(2)
+        evalues = len(query) * state["db_length"] * np.exp2(-bits)
+        for subject, raw, bit, evalue, length, ident in zip(
+                batch, scores, bits, evalues, lengths, idents):
+            if raw <= 0 or evalue > state["evalue"]:
+                continue
+            hits.append((state["ids"][query_index], state["ids"][subject],
+                         ["{:.3f}".format(100 * ident / length),
+                          str(length), "NA", "NA", "NA", "NA", "NA", "NA",
+                          "{:.2g}".format(evalue), "{:.1f}".format(bit)]))
+    return hits
+
+
+def native_hits(input_file, workers=None, gap_pen=NATIVE_GAP_PENALTY,
+                min_shared=MIN_SHARED_KMERS, evalue=1e-10, symmetric=False):
+    """Search all .1 sequences against each other without external tools.
+
+    Pairs sharing at least min_shared k-mers, and clearly more than two
+    random sequences of the same lengths would, are aligned with a local
+    alignment (BLOSUM62, linear gap penalty) in a process pool. Bitscores
+    and e-values use the ungapped BLOSUM62 statistics, so they approximate
+    the blastp values.
+
+    input:
+        input_file: string, name of the fasta file
+        workers: int, number of processes, defaults to the number of cores
+        gap_pen: int, linear gap penalty
+        min_shared: int, minimum number of shared k-mers to align a pair
+        evalue: float, maximum e-value of reported hits
+        symmetric: bool, search every pair of sequences once, the alignment
+                   scores are the same in both directions
+
+    output: generator of tuples, (query_id, subject_id, outfmt 6 values)
+            like parse_blastp(); fields that are not calculated are NA
+    """
+    ids, encoded = [], []
+    for header, seq in read_fasta(input_file):
+        name = header.split()[0]
+        # Only .1 sequences are used for the family tables.
+        if name.split("|")[0].endswith(".1"):
+            ids.append(name)
+            encoded.append(encode_protein(seq))
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                             initializer=_native_init,
+                             initargs=(ids, encoded, gap_pen, min_shared,
+                                       evalue, symmetric)) as pool:
+        for hits in pool.map(_native_search, range(len(ids)), chunksize=4):
+            yield from hits
+
+
+def parse_blastp_lines(lines):
+    """Parse tab separated blastp output lines one at a time.
+
+    input:
+        lines: iterable of strings, outfmt 6 lines
+
+    output: generator of tuples, (query_id, subject_id, list of all other
+            tab-separated values) for every hit between .1 sequences
+    """
+    for line in lines:
+        values = line.rstrip("\n").split("\t")
+        if len(values) < 3:
+            continue
+        query = values[0]
+        subject = values[1]
+        # Only add the line if the query and subject end in .1
+        if query.split("|")[0].endswith(".1") and \
+                subject.split("|")[0].endswith(".1"):
+            yield query, subject, values[2:]
+
+
 def parse_blastp(filename):
-    """Parse a tab separated blastp output file.
+    """Parse a tab separated blastp output file without loading it at once.
 
     input:
         filename: string, filename of .tsv file
 
-    output: dict of tuples, dictionary structured as (query_id, subject_id):
-            tuple containing all other tab-separated values
+    output: generator of tuples, see parse_blastp_lines()
     """
-    parse_dict = {}
-
     with open(filename) as file:
-        for line in file:
-            values = line.strip().split("\t")
-            query = values[0]
-            subject = values[1]
-            # Only add the line if the query and subject end in .1
-            if query.split("|")[0].endswith(".1") and \
-                    subject.split("|")[0].endswith(".1"):
-                parse_dict[(query, subject)] = tuple(values[2:])
+        yield from parse_blastp_lines(file)
+
+
+def tf_family_metrics(hits, metrics=("length",), chunk_size=CHUNK_SIZE):
+    """Make tables of several alignment metrics between TF families.
+
+    The hits are aggregated in a single pass: family names are mapped to
+    integer ids and the fields needed for the requested metrics are added
+    per chunk of hits into NumPy arrays, so memory does not grow with the
+    amount of hits. Every hit is counted once (blastp is run with
+    -max_hsps 1).
+
+    input:
+        hits: iterable of tuples, the output of the parse_blastp() function
+        metrics: iterable of strings, names of metrics from METRICS
+        chunk_size: int, number of hits to collect before adding them up
+
+    output: dict of arrays, metric name: families x families array (NaN for
+            pairs without hits), and the list of families in order of
+            appearance as query
+    """
+    metrics = list(metrics)
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError("Unknown metric {}, choose from {}.".format(
+                metric, ", ".join(METRICS)))
+    # Fields of outfmt 6 (after query and subject) which need summing.
+    fields = {"length": 1, "identity": 0, "bitscore": 9}
+    needed = {name for name in fields if name in metrics}
+    if "bitscore_distance" in metrics:
+        needed.add("bitscore")
+    need_max = "max_bitscore" in metrics
+
+    families = []
+    family_index = {}
+    query_families = {}
+    tables = {name: np.zeros((0, 0)) for name in needed}
+    counts = np.zeros((0, 0), dtype=np.int64)
+    max_bitscore = np.full((0, 0), -np.inf)
+    rows, columns = [], []
+    values_chunk = {name: [] for name in needed}
+    bitscores = []
+
+    def flush(counts, max_bitscore):
+        # Grow the tables to the number of families seen so far.
+        grow = len(families) - len(counts)
+        if grow:
+            for name in tables:
+                tables[name] = np.pad(tables[name], ((0, grow), (0, grow)))
+            counts = np.pad(counts, ((0, grow), (0, grow)))
+            max_bitscore = np.pad(max_bitscore, ((0, grow), (0, grow)),
+                                  constant_values=-np.inf)
+        index = (np.array(rows, dtype=np.intp),
+                 np.array(columns, dtype=np.intp))
+        for name in tables:
+            np.add.at(tables[name], index,
+                      np.array(values_chunk[name], dtype=np.float64))
+            del values_chunk[name][:]
+        np.add.at(counts, index, 1)
+        if need_max:
+            np.maximum.at(max_bitscore, index,
+                          np.array(bitscores, dtype=np.float64))
+        del rows[:], columns[:], bitscores[:]
+        return counts, max_bitscore
 
-    return parse_dict
+    for query, subject, values in hits:
+        query_family = query.split("|")[1]
+        subject_family = subject.split("|")[1]
+        for family in (query_family, subject_family):
+            # Check which families are present in the data.
+            if family not in family_index:
+                family_index[family] = len(families)
+                families.append(family)
+        if query_family not in query_families:
+            query_families[query_family] = family_index[query_family]
+        rows.append(family_index[query_family])
+        columns.append(family_index[subject_family])
+        for name in needed:
+            values_chunk[name].append(float(values[fields[name]]))
+        if need_max:
+            bitscores.append(float(values[9]))
+        if len(rows) >= chunk_size:
+            counts, max_bitscore = flush(counts, max_bitscore)
+    counts, max_bitscore = flush(counts, max_bitscore)
 
+    # Order the families as they first appear as query, then the rest.
+    order = list(query_families.values())
+    order += sorted(set(range(len(families))) - set(order))
+    families = [families[index] for index in order]
+    order = np.ix_(order, order)
+    counts = counts[order]
 
-def tf_family_distances(parsed_blastp):
+    # Average the sums and set empty cells to NaN
+    results = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for name in needed:
+            results[name] = tables[name][order] / counts
+        if "count" in metrics:
+            results["count"] = np.where(counts > 0, counts, np.nan)
+        if need_max:
+            results["max_bitscore"] = np.where(counts > 0,
+                                               max_bitscore[order], np.nan)
+        if "bitscore_distance" in metrics:
+            self_score = np.diagonal(results["bitscore"])
+            norm = np.minimum.outer(self_score, self_score)
+            results["bitscore_distance"] = np.clip(
+                1 - results["bitscore"] / norm, 0, 1)
+    return {metric: results[metric] for metric in metrics}, families
+
+
+def condensed_index(row, column):
+    """Return the position of a cell in a condensed triangular matrix.
+
+    The cells of column c (row <= c) are stored after those of the columns
+    before it, so the array only grows at the end when families are added.
+
+    input:
+        row: int or array of ints, row of the cell
+        column: int or array of ints, column of the cell, may be smaller
+                than row as the matrix is symmetric
+
+    output: int or array of ints, index in the condensed array
+    """
+    low = np.minimum(row, column)
+    high = np.maximum(row, column)
+    return high * (high + 1) // 2 + low
+
+
+def condensed_size(condensed):
+    """Return the number of families of a condensed triangular matrix.
+
+    input:
+        condensed: 1D array, made by tf_family_metrics_symmetric()
+
+    output: int, number of rows (and columns) of the full matrix
+    """
+    return (math.isqrt(8 * len(condensed) + 1) - 1) // 2
+
+
+def expand_condensed(condensed):
+    """Expand a condensed triangular matrix to the full symmetric matrix.
+
+    input:
+        condensed: 1D array, made by tf_family_metrics_symmetric()
+
+    output: 2D array, families x families
+    """
+    indices = np.arange(condensed_size(condensed))
+    return condensed[condensed_index(indices[:, None], indices[None, :])]
+
+
+def condensed_rows(condensed):
+    """Expand a condensed triangular matrix one row at a time.
+
+    input:
+        condensed: 1D array, made by tf_family_metrics_symmetric()
+
+    output: generator of 1D arrays, the rows of the full matrix
+    """
+    indices = np.arange(condensed_size(condensed))
+    for row in indices:
+        yield condensed[condensed_index(row, indices)]
+
+
+def combine_reciprocal(first, second, policy):
+    """Combine the hits of a sequence pair in both directions into one.
+
+    input:
+        first: list of strings, outfmt 6 values (after query and subject)
+        second: list of strings, the values of the reverse hit
+        policy: string, key of RECIPROCAL_POLICIES
+
+    output: list, the values of the combined hit
+    """
+    if policy == "best":
+        return second if float(second[9]) > float(first[9]) else first
+    combined = []
+    for index, (value, other) in enumerate(zip(first, second)):
+        try:
+            value, other = float(value), float(other)
+        except ValueError:
+            # Fields the native backend does not calculate stay NA.
+            combined.append(value)
+            continue
+        if policy == "mean":
+            combined.append((value + other) / 2)
+        elif index == 8:
+            # The best e-value is the lowest one.
+            combined.append(min(value, other))
+        else:
+            combined.append(max(value, other))
+    return combined
+
+
+def tf_family_metrics_symmetric(hits, metrics=("length",), policy="mean",
+                                blocks=None, searched_twice=True,
+                                chunk_size=CHUNK_SIZE):
+    """Make condensed triangular tables of metrics between TF families.
+
+    Every pair of sequences counts once: when both directions of a pair
+    were searched, the two hits are combined with the reciprocal policy
+    first. The sums are kept in condensed arrays (see condensed_index()), so
+    memory is half that of tf_family_metrics().
+
+    input:
+        hits: iterable of tuples, the output of the parse_blastp() function
+        metrics: iterable of strings, names of metrics from METRICS
+        policy: string, key of RECIPROCAL_POLICIES
+        blocks: dict, sequence identifier: shard index as returned by
+                blastp_symmetric(); only pairs in the same shard are searched
+                in both directions. None means all pairs were.
+        searched_twice: bool, False if every pair was searched in one
+                        direction only (the native symmetric search), hits
+                        are then added at once instead of waiting for the
+                        reverse hit
+        chunk_size: int, number of hits to collect before adding them up
+
+    output: dict of 1D arrays, metric name: condensed families x families
+            matrix (NaN for pairs without hits), and the list of families in
+            order of appearance as query
+    """
+    metrics = list(metrics)
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError("Unknown metric {}, choose from {}.".format(
+                metric, ", ".join(METRICS)))
+    if policy not in RECIPROCAL_POLICIES:
+        raise ValueError("Unknown reciprocal policy {}, choose from {}."
+                         "".format(policy, ", ".join(RECIPROCAL_POLICIES)))
+    fields = {"length": 1, "identity": 0, "bitscore": 9}
+    needed = {name for name in fields if name in metrics}
+    if "bitscore_distance" in metrics:
+        needed.add("bitscore")
+    need_max = "max_bitscore" in metrics
+
+    families = []
+    family_index = {}
+    query_families = {}
+    tables = {name: np.zeros(0) for name in needed}
+    counts = np.zeros(0, dtype=np.int64)
+    max_bitscore = np.zeros(0)
+    cells = []
+    values_chunk = {name: [] for name in needed}
+    bitscores = []
+    # Hits waiting for the hit in the other direction.
+    pending = {}
+
+    def add(query, subject, values):
+        cells.append(condensed_index(family_index[query.split("|")[1]],
+                                     family_index[subject.split("|")[1]]))
+        for name in needed:
+            values_chunk[name].append(float(values[fields[name]]))
+        if need_max:
+            bitscores.append(float(values[9]))
+
+    def flush(counts, max_bitscore):
+        # Grow the condensed tables at the end for the new families.
+        grow = len(families) * (len(families) + 1) // 2 - len(counts)
+        if grow:
+            for name in tables:
+                tables[name] = np.pad(tables[name], (0, grow))
+            counts = np.pad(counts, (0, grow))
+            max_bitscore = np.pad(max_bitscore, (0, grow),
+                                  constant_values=-np.inf)
+        index = np.array(cells, dtype=np.intp)
+        for name in tables:
+            np.add.at(tables[name], index,
+                      np.array(values_chunk[name], dtype=np.float64))
+            del values_chunk[name][:]
+        np.add.at(counts, index, 1)
+        if need_max:
+            np.maximum.at(max_bitscore, index,
+                          np.array(bitscores, dtype=np.float64))
+        del cells[:], bitscores[:]
+        return counts, max_bitscore
+
+    for query, subject, values in hits:
+        query_family = query.split("|")[1]
+        subject_family = subject.split("|")[1]
+        for family in (query_family, subject_family):
+            if family not in family_index:
+                family_index[family] = len(families)
+                families.append(family)
+        if query_family not in query_families:
+            query_families[query_family] = family_index[query_family]
+        if searched_twice and query != subject and \
+                (blocks is None or query in blocks and
+                 blocks[query] == blocks.get(subject)):
+            reverse = pending.pop((subject, query), None)
+            if reverse is None:
+                pending[(query, subject)] = values
+                continue
+            values = combine_reciprocal(reverse, values, policy)
+        add(query, subject, values)
+        if len(cells) >= chunk_size:
+            counts, max_bitscore = flush(counts, max_bitscore)
+    # Pairs of which the reverse hit did not pass the e-value cutoff.
+    for (query, subject), values in pending.items():
+        add(query, subject, values)
+    counts, max_bitscore = flush(counts, max_bitscore)
+
+    # Order the families as they first appear as query, then the rest.
+    order = list(query_families.values())
+    order += sorted(set(range(len(families))) - set(order))
+    families = [families[index] for index in order]
+    order = np.array(order, dtype=np.intp)
+    columns = np.repeat(np.arange(len(order)), np.arange(1, len(order) + 1))
+    rows = np.arange(len(columns)) - columns * (columns + 1) // 2
+    source = condensed_index(order[rows], order[columns])
+    counts = counts[source]
+
+    results = {}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for name in needed:
+            results[name] = tables[name][source] / counts
+        if "count" in metrics:
+            results["count"] = np.where(counts > 0, counts, np.nan)
+        if need_max:
+            results["max_bitscore"] = np.where(counts > 0,
+                                               max_bitscore[source], np.nan)
+        if "bitscore_distance" in metrics:
+            self_score = results["bitscore"][condensed_index(
+                np.arange(len(order)), np.arange(len(order)))]
+            norm = np.minimum(self_score[rows], self_score[columns])
+            results["bitscore_distance"] = np.clip(
+                1 - results["bitscore"] / norm, 0, 1)
+    return {metric: results[metric] for metric in metrics}, families
+
+
+def matrix_to_table(matrix):
+    """Convert a family matrix to a list of lists with None for empty cells.
+
+    input:
+        matrix: 2D array, NaN marks an empty cell
+
+    output: list of lists of floats or None
+    """
+    return [[None if np.isnan(value) else float(value) for value in row]
+            for row in matrix]
+
+
+def tf_family_distances(hits, chunk_size=CHUNK_SIZE):
     """Make a table of the average alignment length between TF families.
 
     input:
-        parsed_blastp: dict of tuples, the output of the parse_blastp()
-        function
+        hits: iterable of tuples, the output of the parse_blastp() function
+        chunk_size: int, number of hits to collect before adding them up
 
     output: list of lists, a table of average alignment lengths between TF
-            families
+            families (None for pairs without hits), and the list of
+            families in order of appearance
     """
-    families = []
-    for query, subject in parsed_blastp.keys():
-        query, family = query.split("|")
-        # Check which families are present in the data.
-        if not family in families:
-            families.append(family)
-
-    # Init TF table in same size as families x families.
-    tf_table = [[[0, 0] for item in families] for item in families]
-
-    for key in parsed_blastp.keys():
-        # Get the index of the families from the families list.
-        fam_query_index = families.index(key[0].split("|")[1])
-        fam_subj_index = families.index(key[1].split("|")[1])
-        # Sum lengths and amount of alignments
-        tf_table[fam_query_index][fam_subj_index][0] += \
-            int(parsed_blastp[key][1])
-        tf_table[fam_query_index][fam_subj_index][1] += 1
-
-    # Average lengths and set empty cells to None
-    for row in range(len(tf_table)):
-        for column, values in enumerate(tf_table[row]):
-            if values[1] == 0:
-                tf_table[row][column] = None
-            else:
-                tf_table[row][column] = values[0] / values[1]
-    return tf_table, families
+    tables, families = tf_family_metrics(hits, ("length",), chunk_size)
+    return matrix_to_table(tables["length"]), families
+
+
+def metric_filename(filename, metric, n_metrics):
+    """Return the output filename for a metric.
+
+    input:
+        filename: string, output filename given by the user
+        metric: string, name of the metric
+        n_metrics: int, number of metrics written
+
+    output: string, filename itself for a single metric, otherwise the
+            metric name is added before the extension
+    """
+    if n_metrics == 1:
+        return filename
+    root, extension = os.path.splitext(filename)
+    return "{}_{}{}".format(root, metric, extension)
+
+
+def format_cell(cell):
+    """Format a single matrix cell for text output.
+
+    input:
+        cell: float, None or NaN for an empty cell
+
+    output: string, the value with one decimal, or "" for an empty cell
+    """
+    if cell is None or cell != cell:
+        return ""
+    return "{:.1f}".format(cell)
 
 
 def write_csv(data, headers, filename):
     """Write a list of lists (each sublist containing floats) to a csv file.
 
     input:
-        data: list of lists which contain floats, data to write to file
+        data: list of lists (or 2D array) which contain floats, None or NaN
+              marks an empty cell
         headers: list of strings containing, headers will be applied to both
                  rows and columns
         filename: string, name of file to write to
 
     output: None, function raises errors.
     """
-    with open(filename, "w+") as file:
+    with open(filename, "w") as file:
         # Write header
         file.write(",{}\n".format(",".join(headers)))
-        for row_i, row in enumerate(data):
-            # Write header for each rows
-            file.write("{},".format(headers[row_i]))
-            for column_i, cell in enumerate(row):
-                if column_i < len(row) - 1:
-                    if cell:
-                        file.write("{:.1f},".format(cell))
-                    else:
-                        file.write(",")
-                # Last cell should not have a comma
-                else:
-                    if cell:
-                        file.write("{:.1f}".format(cell))
-                    else:
-                        file.write("")
-            file.write("\n")
+        # Write each row with its header in one go
+        file.writelines("{},{}\n".format(header, ",".join(
+            format_cell(cell) for cell in row))
+            for header, row in zip(headers, data))
+
+
+def write_sparse(matrix, headers, filename):
+    """Write the filled cells of a family matrix as (row, column, value).
+
+    The families are also written to <filename>.families, so families
+    without any filled cell and their order are kept.
+
+    input:
+        matrix: 2D array, NaN marks an empty cell
+        headers: list of strings, family names of the rows and columns
+        filename: string, name of the tab-separated file to write to
+
+    output: None, function raises errors.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    rows, columns = np.nonzero(~np.isnan(matrix))
+    with open(filename, "w") as file:
+        file.write("row\tcolumn\tvalue\n")
+        file.writelines("{}\t{}\t{!r}\n".format(headers[row],
+                                                headers[column],
+                                                float(matrix[row, column]))
+                        for row, column in zip(rows, columns))
+    with open(filename + ".families", "w") as file:
+        file.writelines(header + "\n" for header in headers)
+
+
+def write_npy(matrix, headers, filename):
+    """Write a family matrix as .npy, with the families in <filename>.families.
+
+    input:
+        matrix: 2D array, NaN marks an empty cell
+        headers: list of strings, family names of the rows and columns
+        filename: string, name of the .npy file to write to
+
+    output: None, function raises errors.
+    """
+    with open(filename, "wb") as file:
+        np.save(file, np.asarray(matrix, dtype=np.float64))
+    with open(filename + ".families", "w") as file:
+        file.writelines(header + "\n" for header in headers)
+
+
+def write_npz(matrix, headers, filename):
+    """Write a family matrix and its families to a compressed .npz file.
+
+    input:
+        matrix: 2D array, NaN marks an empty cell
+        headers: list of strings, family names of the rows and columns
+        filename: string, name of the .npz file to write to
+
+    output: None, function raises errors.
+    """
+    with open(filename, "wb") as file:
+        np.savez_compressed(file, matrix=np.asarray(matrix, dtype=np.float64),
+                            families=np.array(headers, dtype=str))
+
+
+def write_columns(matrix, headers, filename):
+    """Write the filled cells of a family matrix in a columnar layout.
+
+    The directory gets one .npy file per column (row, column, value), which
+    can be memory-mapped separately, and a families.txt with the names the
+    row and column indices refer to.
+
+    input:
+        matrix: 2D array, NaN marks an empty cell
+        headers: list of strings, family names of the rows and columns
+        filename: string, name of the directory to write to
+
+    output: None, function raises errors.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    rows, columns = np.nonzero(~np.isnan(matrix))
+    os.makedirs(filename, exist_ok=True)
+    np.save(os.path.join(filename, "row.npy"), rows.astype(np.int32))
+    np.save(os.path.join(filename, "column.npy"), columns.astype(np.int32))
+    np.save(os.path.join(filename, "value.npy"), matrix[rows, columns])
+    with open(os.path.join(filename, "families.txt"), "w") as file:
+        file.writelines(header + "\n" for header in headers)
+
+
+# Output formats for the family matrices.
+WRITERS = {"csv": write_csv, "sparse": write_sparse, "npy": write_npy,
+           "npz": write_npz, "columns": write_columns}
+
+
+def load_matrix(filename, file_format=None):
+    """Load a family matrix written by one of the WRITERS.
+
+    .npy matrices are memory-mapped read-only, so large matrices are not
+    read into memory until they are used.
+
+    input:
+        filename: string, name of the file (or directory for columns)
+        file_format: string, key of WRITERS, guessed from the name if None
+
+    output: 2D array with NaN for empty cells, and the list of families
+    """
+    if file_format is None:
+        if os.path.isdir(filename):
+            file_format = "columns"
+        else:
+            extension = os.path.splitext(filename)[1].lstrip(".").lower()
+            file_format = extension if extension in WRITERS else \
+                ("sparse" if extension == "tsv" else "csv")
+
+    if file_format == "npy":
+        with open(filename + ".families") as file:
+            families = [line.rstrip("\n") for line in file]
+        return np.load(filename, mmap_mode="r"), families
+
+    if file_format == "npz":
+        with np.load(filename) as data:
+            return data["matrix"], data["families"].tolist()
+
+    if file_format == "columns":
+        with open(os.path.join(filename, "families.txt")) as file:
+            families = [line.rstrip("\n") for line in file]
+        matrix = np.full((len(families), len(families)), np.nan)
+        columns = [np.load(os.path.join(filename, name + ".npy"),
+                           mmap_mode="r")
+                   for name in ("row", "column", "value")]
+        matrix[columns[0], columns[1]] = columns[2]
+        return matrix, families
+
+    if file_format == "sparse":
+        with open(filename) as file:
+            next(file)
+            cells = [line.rstrip("\n").split("\t") for line in file]
+        if os.path.exists(filename + ".families"):
+            with open(filename + ".families") as file:
+                families = [line.rstrip("\n") for line in file]
+        else:
+            # Older files without families: use the order of the cells.
+            families = list(dict.fromkeys(
+                family for row, column, value in cells
+                for family in (row, column)))
+        index = {family: i for i, family in enumerate(families)}
+        matrix = np.full((len(families), len(families)), np.nan)
+        for row, column, value in cells:
+            matrix[index[row], index[column]] = float(value)
+        return matrix, families
+
+    with open(filename) as file:
+        families = file.readline().rstrip("\n").split(",")[1:]
+        matrix = np.array([[float(cell) if cell else np.nan
+                            for cell in line.rstrip("\n").split(",")[1:]]
+                           for line in file]).reshape(len(families),
+                                                      len(families))
+    return matrix, families
+
+
+def family_distance(matrix, metric):
+    """Turn a family metric matrix into a symmetric distance matrix.
+
+    Similarities are scaled to distances between 0 and 1: identity as
+    1 - identity / 100, the other metrics relative to the lowest value of
+    both families to themselves. Both directions of a pair are averaged and
+    pairs without hits get the maximum distance of 1.
+
+    input:
+        matrix: 2D array, output of tf_family_metrics(), NaN for empty cells
+        metric: string, the metric in the matrix
+
+    output: 2D array of float64, symmetric distances with a zero diagonal
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if metric == "bitscore_distance":
+            distance = matrix.copy()
+        elif metric == "identity":
+            distance = 1 - matrix / 100
+        else:
+            self_value = np.diagonal(matrix)
+            distance = 1 - matrix / np.minimum.outer(self_value, self_value)
+    distance = np.clip(distance, 0, 1)
+
+    # Average both directions where available.
+    mirrored = distance.T
+    both = ~np.isnan(distance) & ~np.isnan(mirrored)
+    distance = np.where(both, (distance + mirrored) / 2,
+                        np.where(np.isnan(distance), mirrored, distance))
+    distance[np.isnan(distance)] = 1.0
+    np.fill_diagonal(distance, 0.0)
+    return distance
+
+
+def upgma(distance):
+    """Cluster with UPGMA using the nearest-neighbour chain algorithm.
+
+    Works in place on one n x n array, so memory is O(n^2), and the chain
+    makes the number of row scans O(n) per merge on average.
+
+    input:
+        distance: 2D array, symmetric distance matrix
+
+    output: list of tuples, (left, right, left_length, right_length) for
+            every merge; leaves are 0..n-1 and merge k creates node n + k
+    """
+    matrix = np.array(distance, dtype=np.float64)
+    n_leaves = len(matrix)
+    np.fill_diagonal(matrix, np.inf)
+    size = np.ones(n_leaves)
+    height = np.zeros(n_leaves)
+    node = list(range(n_leaves))
+    merges = []
+    chain = []
+    remaining = n_leaves
+
+    while remaining > 1:
+        if not chain:
+            chain.append(int(np.flatnonzero(np.isfinite(size))[0]))
+        current = chain[-1]
+        row = matrix[current]
+        nearest = int(row.argmin())
+        # Prefer the previous element of the chain on ties.
+        if len(chain) > 1 and row[chain[-2]] <= row[nearest]:
+            nearest = chain[-2]
+
+        if len(chain) > 1 and nearest == chain[-2]:
+            chain = chain[:-2]
+            left, right = sorted((current, nearest))
+            half = matrix[left, right] / 2
+            merges.append((node[left], node[right], half - height[left],
+                           half - height[right]))
+            # Merged cluster takes the place of left, right is removed.
+            total = size[left] + size[right]
+            with np.errstate(invalid="ignore"):
+                merged = (size[left] * matrix[left] +
+                          size[right] * matrix[right]) / total
+            merged[np.isnan(merged)] = np.inf
+            matrix[left] = merged
+            matrix[:, left] = merged
+            matrix[left, left] = np.inf
+            matrix[right] = np.inf
+            matrix[:, right] = np.inf
+            size[left] = total
+            size[right] = np.inf
+            height[left] = half
+            node[left] = n_leaves + len(merges) - 1
+            remaining -= 1
+        else:
+            chain.append(nearest)
+    return merges
+
+
+def neighbor_joining(distance, block=8):
+    """Build a tree with the neighbor-joining algorithm.
+
+    Instead of rebuilding the whole Q matrix every join, the pair with the
+    lowest Q is searched like RapidNJ: every row keeps its distances sorted,
+    and since Q(i, j) >= (n - 2) * d(i, j) - r(i) - max(r), a row is only
+    scanned until that bound cannot beat the best Q found so far. All rows
+    are scanned together, block columns at a time. A row only holds the
+    clusters which existed when it was made, pairs with newer clusters are
+    in the row of the newer one. Entries of joined clusters are skipped and
+    removed from the rows now and then.
+
+    input:
+        distance: 2D array, symmetric distance matrix
+        block: int, number of sorted columns scanned at once
+
+    output: list of tuples, (left, right, left_length, right_length) for
+            every join; leaves are 0..n-1 and join k creates node n + k
+    """
+    matrix = np.array(distance, dtype=np.float64)
+    n_leaves = len(matrix)
+    node = list(range(n_leaves))
+    totals = matrix.sum(axis=1)
+    alive = np.ones(n_leaves, dtype=bool)
+    # Join in which the cluster in a slot was made, to spot reused slots.
+    born = np.zeros(n_leaves, dtype=np.int64)
+    merges = []
+    size = n_leaves
+
+    # Sorted distances of every row and the slots they belong to.
+    masked = matrix.copy()
+    np.fill_diagonal(masked, np.inf)
+    order = np.argsort(masked, axis=1, kind="stable").astype(np.int32)
+    values = np.take_along_axis(masked, order, axis=1)
+    del masked
+    compacted = size
+    # Highest r from each column of the sorted rows onwards. A join lowers
+    # r by (d(f, k) + d(s, k) + d(f, s)) / 2, so while the distances stay
+    # positive these remain upper bounds.
+    r_bound = np.maximum.accumulate(totals[order][:, ::-1], axis=1)[:, ::-1]
+    use_r_bound = bool((matrix >= 0).all())
+
+    while size > 2:
+        # Search the pair with the lowest Q using the bounds.
+        rows = np.flatnonzero(alive)
+        r_max = totals[rows].max()
+        best, first, second = np.inf, -1, -1
+        for start in range(0, n_leaves, block):
+            row_values = values[rows, start:start + block]
+            columns = order[rows, start:start + block]
+            q_values = (size - 2) * row_values - totals[rows, None] - \
+                totals[columns]
+            valid = alive[columns] & (born[columns] <= born[rows, None]) & \
+                (columns != rows[:, None])
+            q_values[~valid] = np.inf
+            index = int(q_values.argmin())
+            if q_values.flat[index] < best:
+                best = q_values.flat[index]
+                first = int(rows[index // q_values.shape[1]])
+                second = int(columns.flat[index])
+            # Keep the rows of which later columns could still beat best.
+            following = start + block
+            if following >= n_leaves:
+                break
+            r_later = np.minimum(r_bound[rows, following], r_max) \
+                if use_r_bound else r_max
+            bound = (size - 2) * values[rows, following] - totals[rows] - \
+                r_later
+            rows = rows[bound < best]
+            if not len(rows):
+                break
+        first, second = min(first, second), max(first, second)
+
+        pair = matrix[first, second]
+        first_length = pair / 2 + (totals[first] - totals[second]) / \
+            (2 * (size - 2))
+        second_length = pair - first_length
+        merges.append((node[first], node[second], max(first_length, 0.0),
+                       max(second_length, 0.0)))
+
+        # New cluster replaces first, second is removed.
+        alive[second] = False
+        new_row = (matrix[first] + matrix[second] - pair) / 2
+        new_row[~alive] = 0.0
+        new_row[first] = 0.0
+        totals += new_row - matrix[first] - matrix[second]
+        matrix[first] = new_row
+        matrix[:, first] = new_row
+        matrix[second] = 0.0
+        matrix[:, second] = 0.0
+        totals[first] = new_row.sum()
+        totals[second] = 0.0
+        node[first] = n_leaves + len(merges) - 1
+        born[first] = len(merges)
+        size -= 1
+
+        # Sorted row of the new cluster, joined clusters at the end.
+        new_row = np.where(alive, new_row, np.inf)
+        new_row[first] = np.inf
+        order[first] = np.argsort(new_row, kind="stable")
+        values[first] = new_row[order[first]]
+        r_bound[first] = np.maximum.accumulate(
+            totals[order[first]][::-1])[::-1]
+        use_r_bound = use_r_bound and bool((new_row >= 0).all())
+
+        if size <= compacted // 2:
+            # Move the entries of joined clusters out of the rows.
+            valid = alive[order] & (born[order] <= born[:, None])
+            values[~valid] = np.inf
+            moved = np.argsort(~valid, axis=1, kind="stable")
+            order = np.take_along_axis(order, moved, axis=1)
+            values = np.take_along_axis(values, moved, axis=1)
+            r_bound = np.maximum.accumulate(
+                np.where(np.isfinite(values), totals[order], -np.inf)[:, ::-1],
+                axis=1)[:, ::-1]
+            compacted = size
+
+    if size == 2:
+        first, second = np.flatnonzero(alive)
+        half = matrix[first, second] / 2
+        merges.append((node[first], node[second], half, half))
+    return merges
+
+
+def newick_label(label):
+    """Quote a label for Newick output if it contains special characters.
+
+    input:
+        label: string, family name
+
+    output: string, label safe to use in a Newick tree
+    """
+    if any(char in label for char in " ()[]':;,\t"):
+        return "'{}'".format(label.replace("'", "''"))
+    return label
+
+
+def to_newick(merges, labels):
+    """Write a tree made by upgma() or neighbor_joining() as Newick.
+
+    input:
+        merges: list of tuples, (left, right, left_length, right_length)
+        labels: list of strings, names of the leaves
+
+    output: string, the tree in Newick format
+    """
+    n_leaves = len(labels)
+    if not merges:
+        return "{};".format(";".join(newick_label(label)
+                                     for label in labels))
+    # Nodes are created after their children, so no recursion is needed.
+    text = [newick_label(label) for label in labels]
+    for left, right, left_length, right_length in merges:
+        text.append("({}:{:.6g},{}:{:.6g})".format(
+            text[left], left_length, text[right], right_length))
+        text[left] = text[right] = None
+    return text[n_leaves + len(merges) - 1] + ";"
+
+
+# Tree building methods for the family distance matrix.
+TREE_METHODS = {"upgma": upgma, "nj": neighbor_joining}
 
 
 def main():
     """Main function."""
-    check_user_input()
-    # Only run blastp if needed.
-    if not os.path.exists(argv[1] + "_blastp.tsv"):
-        blastp(argv[1], argv[1])
+    args = parse_arguments()
+    blastp_args = {"shards": args.shards, "workers": args.workers,
+                   "retries": args.retries, "blastp_bin": args.blastp,
+                   "makeblastdb_bin": args.makeblastdb,
+                   "dbsize": args.dbsize}
+    blocks = None
+    searched_twice = True
+    if args.backend == "native":
+        # Search in-process, hits are aggregated as they are found.
+        blastp_output = native_hits(args.input, workers=args.workers,
+                                    symmetric=args.symmetric)
+        # Every pair is searched in one direction only.
+        searched_twice = not args.symmetric
+    elif args.symmetric:
+        # Search the upper triangle of the shards only.
+        blocks = blastp_symmetric(args.input, **blastp_args)
+        blastp_output = parse_blastp(args.input + "_blastp_symmetric.tsv")
+    elif args.stream:
+        # Aggregate the hits as the blastp shards write them.
+        tee_file = args.input + "_blastp.tsv" if args.keep_tsv else None
+        blastp_output = parse_blastp_lines(
+            blastp_stream(args.input, args.input, tee_file=tee_file,
+                          **blastp_args))
+    else:
+        if args.no_cache:
+            # Only run blastp if needed.
+            if not os.path.exists(args.input + "_blastp.tsv"):
+                blastp(args.input, args.input, **blastp_args)
+        else:
+            # Search only the sequences the cache does not know yet.
+            cached_blastp(args.input, args.cache or
+                          args.input + "_blastp_cache.sqlite", **blastp_args)
 
-    # Parse blastp into dict
-    blastp_output = parse_blastp(argv[1] + "_blastp.tsv")
+        # Stream the blastp hits
+        blastp_output = parse_blastp(args.input + "_blastp.tsv")
+
+    # Make tables of TF-family alignments
+    tree_metric = args.tree_metric or args.metrics[0]
+    metrics = list(args.metrics)
+    if args.tree and tree_metric not in metrics:
+        metrics.append(tree_metric)
+    if args.symmetric:
+        tables, families = tf_family_metrics_symmetric(
+            blastp_output, metrics, args.reciprocal, blocks, searched_twice)
+    else:
+        tables, families = tf_family_metrics(blastp_output, metrics)
 
-    # Make table of TF-family alignments
-    tf_table, families = tf_family_distances(blastp_output)
+    # Write tables in the chosen format
+    for metric in args.metrics:
+        table = tables[metric]
+        if args.symmetric:
+            # Expand the condensed tables only now, row by row for csv.
+            table = condensed_rows(table) if args.format == "csv" else \
+                expand_condensed(table)
+        WRITERS[args.format](table, families,
+                             metric_filename(args.output, metric,
+                                             len(args.metrics)))
 
-    # Write table to csv
-    write_csv(tf_table, families, argv[2])
+    # Cluster the families and write the tree
+    if args.tree:
+        table = tables[tree_metric]
+        if args.symmetric:
+            table = expand_condensed(table)
+        distance = family_distance(table, tree_metric)
+        tree = to_newick(TREE_METHODS[args.tree](distance), families)
+        tree_output = args.tree_output or \
+            os.path.splitext(args.output)[0] + ".nwk"
+        with open(tree_output, "w") as file:
+            file.write(tree + "\n")
 
 
 if __name__ == "__main__":
@@ -3,17 +3,152 @@
 Author: Matthijs Pon
 Date: 2021-08-06
 
-Description: Script to run the ViroMatch pipeline for multiple samples in series.
-The ViroMatch pipeline is described in the following paper: https://doi.org/10.1128/MRA.01468-20
+Description: Script to run the ViroMatch pipeline for multiple samples, several at the same time if the settings allow
+it. The ViroMatch pipeline is described in the following paper: https://doi.org/10.1128/MRA.01468-20
 """
 
 
 import ast
+import fcntl
+import gzip
+import hashlib
+import json
 import shlex
+import shutil
+import socket
 import sys
 import subprocess
 import os.path
 import re
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Settings which may be left out of settings.txt, with the value used in that case.
+DEFAULT_SETTINGS = {"max_concurrent": "1", "memory_limit": "", "sample_memory": "", "container_engine": "docker",
+                    "max_retries": "2", "retry_delay": "60", "scratch_directory": "", "staging_workers": "2",
+                    "stats_interval": "10", "database_cache": "", "verify_databases": "no",
+                    "prefetch_databases": "no", "sample_order": "longest_first", "queue_mode": "local",
+                    "lease_time": "900", "heartbeat_interval": "60"}
+# Name of the job ledger in the output directory, which keeps track of the samples between runs. With a shared queue
+# every worker writes its own ledger, named after the worker.
+LEDGER_FILE = "viromatch_ledger.json"
+# Directory in the output directory with the claims of the shared queue.
+QUEUE_DIRECTORY = "viromatch_queue"
+# Name of the report of the last batch in the output directory and its columns, which are also kept in the ledger.
+REPORT_FILE = "viromatch_report.tsv"
+REPORT_COLUMNS = ("state", "attempts", "threads", "wall_time", "cpu_time", "cpu_efficiency", "max_memory_mb",
+                  "input_bytes", "uncompressed_bytes", "reads", "reads_per_second", "resource_source", "databases",
+                  "speedup")
+# Report columns measured by a run, which are cleared when a sample pair runs again so a failure never shows the numbers
+# of an earlier run.
+MEASURED_COLUMNS = tuple(column for column in REPORT_COLUMNS if column not in ("state", "attempts"))
+# Settings with the database directories which are mounted into the container.
+DATABASES = ("ncbi_nt", "ncbi_nr", "viral_nt", "viral_nr", "host", "adaptor", "taxonomy")
+# Name of the manifest in a local database copy, which keeps track of the copied files.
+MANIFEST_FILE = ".viromatch_manifest.json"
+# Lock file in the database_cache directory, so only one wrapper on a host copies the databases at a time.
+SYNC_LOCK_FILE = ".viromatch_sync.lock"
+# Rough compression ratio of gzipped fastq files, to compare their size with uncompressed samples before staging.
+GZIP_RATIO = 4
+# Units docker stats uses for the memory usage, in bytes.
+MEMORY_UNITS = {"b": 1, "kb": 10 ** 3, "mb": 10 ** 6, "gb": 10 ** 9, "tb": 10 ** 12,
+                "kib": 2 ** 10, "mib": 2 ** 20, "gib": 2 ** 30, "tib": 2 ** 40}
+# Container engines of which the resource usage of the client process says nothing about the container itself.
+CONTAINER_ENGINES = ("docker", "podman")
+# Seconds between two readings of the cgroup of a running container, which is cheap compared to "docker stats".
+CGROUP_INTERVAL = 1
+
+
+def parse_memory(text):
+    """Convert a memory size as docker prints it (e.g. "1.5GiB") to bytes.
+
+    :param text: the memory size with its unit.
+    :return: The size in bytes, or None if it could not be read.
+    """
+    match = re.match(r"\s*([0-9.]+)\s*([a-zA-Z]*)", text)
+    if not match or match.group(2).lower() not in MEMORY_UNITS:
+        return None
+    return float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()]
+
+
+def cgroup_usage(path):
+    """Read the CPU time and peak memory of a (version 2) cgroup.
+
+    :param path: the directory of the cgroup, e.g. /sys/fs/cgroup/system.slice/docker-<id>.scope.
+    :return: A tuple of (CPU time in seconds, memory in bytes), or None if the cgroup could not be read. The memory
+    is the peak usage if the kernel keeps track of it, otherwise the current usage.
+    """
+    try:
+        with open(os.path.join(path, "cpu.stat")) as file:
+            cpu_stat = dict(line.split() for line in file if line.strip())
+        for name in ("memory.peak", "memory.current"):
+            if os.path.exists(os.path.join(path, name)):
+                with open(os.path.join(path, name)) as file:
+                    memory = int(file.read())
+                break
+        else:
+            return None
+        return int(cpu_stat["usage_usec"]) / 10 ** 6, memory
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def count_reads(filename):
+    """Count the reads in an uncompressed fastq file (four lines per read).
+
+    :param filename: the fastq file.
+    :return: The amount of reads, or None if the file could not be read.
+    """
+    lines = 0
+    last = b"\n"
+    try:
+        with open(filename, "rb") as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b""):
+                lines += chunk.count(b"\n")
+                last = chunk[-1:]
+    except OSError:
+        return None
+    # A last line without a newline still counts.
+    return (lines + (last != b"\n")) // 4
+
+
+def file_checksum(filename):
+    """Calculate the SHA-256 checksum of a file.
+
+    :param filename: the file.
+    :return: The hexadecimal checksum.
+    """
+    checksum = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def prefetch_directory(directory):
+    """Ask the kernel to read all files in a directory into the page cache, without waiting for it.
+
+    :param directory: the directory.
+    :return: The total size of the files in bytes.
+    """
+    size = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                with open(os.path.join(root, name), "rb") as file:
+                    size += os.fstat(file.fileno()).st_size
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    else:
+                        # No read-ahead hint on this system, read the file through once instead.
+                        while file.read(1024 * 1024):
+                            pass
+            except OSError:
+                pass
+    return size
 
 
 class ViroMatchWrapper:
@@ -22,6 +157,25 @@ class ViroMatchWrapper:
         self.samples = []
         self.current_sample = None
         self.reg_exp_present = False
+        self.status = {}
+        self.status_lock = threading.Lock()
+        self.ledger = {}
+        self.own_entries = set()
+        self.ledger_lock = threading.Lock()
+        self.queue = []
+        self.staging = {}
+        self.staging_lock = threading.Lock()
+        self.staging_pool = None
+        self.staging_ahead = 1
+        self.databases = {}
+        self.database_mode = "direct"
+        self.baseline_rate = None
+        self.worker_id = "{}-{}".format(socket.gethostname(), os.getpid())
+        self.claims = set()
+        self.lost = set()
+        self.claims_lock = threading.Lock()
+        self.queue_lock = threading.Lock()
+        self.ran = []
         self.parse_settings()
 
     def parse_settings(self):
@@ -30,6 +184,7 @@ class ViroMatchWrapper:
         :return: All the settings are put into the self.settings dictionary, except for the samples variable, which is
         put in self.samples.
         """
+        self.settings.update(DEFAULT_SETTINGS)
         with open("settings.txt") as file:
             current_var = ""
             for line in file:
@@ -72,44 +227,89 @@ class ViroMatchWrapper:
                     if len(self.samples[i]) != 2:
                         sys.exit("Something wrong with the sample format. Please give a list of tuples (max 2 items"
                                  " per tuple. Error in {}".format(self.samples[i]))
-        # Check if the cores setting is an actual integer
-        try:
-            int(self.settings["cores"])
-        except ValueError:
-            sys.exit("Something is wrong with the cores parameter. It is not an integer.")
+        # Check if the cores and concurrency settings are actual integers
+        for setting in ("cores", "max_concurrent", "max_retries", "retry_delay", "staging_workers", "stats_interval",
+                        "lease_time", "heartbeat_interval"):
+            try:
+                if int(self.settings[setting]) < (0 if setting in ("max_retries", "retry_delay") else 1):
+                    raise ValueError
+            except ValueError:
+                sys.exit("Something is wrong with the {} parameter. It is not an integer or too small.".format(setting))
+        for setting in ("verify_databases", "prefetch_databases"):
+            if self.settings[setting] not in ("yes", "no"):
+                sys.exit("Something is wrong with the {} parameter. It should be yes or no.".format(setting))
+        if self.settings["sample_order"] not in ("longest_first", "as_found"):
+            sys.exit("Something is wrong with the sample_order parameter. It should be longest_first or as_found.")
+        if self.settings["queue_mode"] not in ("local", "shared"):
+            sys.exit("Something is wrong with the queue_mode parameter. It should be local or shared.")
+        if int(self.settings["heartbeat_interval"]) * 2 > int(self.settings["lease_time"]):
+            sys.exit("The lease_time should be at least twice the heartbeat_interval, otherwise leases expire while "
+                     "their worker is still alive.")
+        # Memory settings are optional, but should be numbers (GB) when given
+        for setting in ("memory_limit", "sample_memory"):
+            if self.settings[setting] != "":
+                try:
+                    float(self.settings[setting])
+                except ValueError:
+                    sys.exit("Something is wrong with the {} parameter. It is not a number.".format(setting))
+
+    def sample_pattern(self):
+        """Translate the regular_expression setting (a shell pattern with "{}" at the mate number) to a compiled regex.
+
+        :return: A compiled regular expression which matches a complete file name, with or without a .gz extension, and
+        captures the mate number (1 or 2) in the group "mate".
+        """
+        parts = []
+        for char in self.settings["regular_expression"].replace("{}", "\0"):
+            if char == "*":
+                parts.append(".*")
+            elif char == "?":
+                parts.append(".")
+            elif char == "\0":
+                parts.append("(?P<mate>[12])")
+            else:
+                parts.append(re.escape(char))
+        return re.compile("".join(parts) + r"(?:\.gz)?\Z", re.DOTALL)
 
     def search_samples(self):
         """Search the samples automatically in the given directory.
 
+        The directory is listed once with os.scandir and every file matching the regular expression is grouped with its
+        mate by the rest of its name.
+
         :return: A list of tuples, representing all the different sample pairs.
         """
         # Only search for samples if samples are not given and there is a regular expression. Otherwise give an error
         # or skip the functions, since samples are already given.
         if not self.samples and self.reg_exp_present:
             if os.path.isdir(self.settings["sample_directory"]):
-                path = self.settings["sample_directory"]
-                # Shell regular expression for finding the first files.
-                reg_expr = self.settings["regular_expression"].format("1")
-                # Python regular expression for checking if the 2nd file matches the 1st.
-                python_reg_expr = re.compile(self.settings["regular_expression"].replace("*", ".+").format("2"))
+                pattern = self.sample_pattern()
+                if "mate" not in pattern.groupindex:
+                    sys.exit("The regular expression should contain {} on the location of the 1 or 2.")
 
-                # Try the ls command. And decode if it works.
+                # Group the files by their name without the mate number.
+                pairs = {}
                 try:
-                    list_files = subprocess.check_output("ls {path}/{reg_expr}".format(path=path, reg_expr=reg_expr),
-                                                         shell=True)
-                except subprocess.CalledProcessError as ls_error:
-                    sys.exit("Something went wrong with listing the files in the sample directory using the given "
-                             "regular expression. Error: {}".format(ls_error.output))
-                list_files = list_files.decode("UTF-8")
-
-                # Gather only the filenames from the ls output and search a partner file for them.
-                for file in str(list_files).split():
-                    file = file.split("/")[-1]
-                    for i in range(len(file)):
-                        if file[i] == "1":
-                            temp_file = file[:i] + "2" + file[i + 1:]
-                            if bool(re.match(python_reg_expr, temp_file)):
-                                self.samples.append((file, temp_file))
+                    with os.scandir(self.settings["sample_directory"]) as entries:
+                        for entry in entries:
+                            match = pattern.match(entry.name)
+                            if match:
+                                stem = entry.name[:match.start("mate")] + "{}" + entry.name[match.end("mate"):]
+                                if stem.endswith(".gz"):
+                                    stem = stem[:-3]
+                                pair = pairs.setdefault(stem, {})
+                                # Prefer an uncompressed file over its gzipped copy, it does not need staging.
+                                if pair.get(match.group("mate"), ".gz").endswith(".gz"):
+                                    pair[match.group("mate")] = entry.name
+                except OSError as scandir_error:
+                    sys.exit("Something went wrong with listing the files in the sample directory. Error: {}"
+                             "".format(scandir_error))
+
+                for stem in sorted(pairs):
+                    if len(pairs[stem]) == 2:
+                        self.samples.append((pairs[stem]["1"], pairs[stem]["2"]))
+                    else:
+                        print("Skipping {}, no partner file found".format(list(pairs[stem].values())[0]))
 
         elif not self.samples and not self.reg_exp_present:
             sys.exit("No samples or regular expression given. Please give either one in settings.txt.")
@@ -127,19 +327,267 @@ class ViroMatchWrapper:
         else:
             self.current_sample = None
 
-    def run_viromatch(self):
-        """Run the actual viromatch command using the parsed settings."""
+    def input_bytes(self, names, directory=None):
+        """Read the size of the files of a sample pair on disk.
+
+        :param names: the file names of the sample pair.
+        :param directory: the directory which holds the files, defaults to the sample directory.
+        :return: The total size in bytes, or None if a file is missing or cannot be read.
+        """
+        if directory is None:
+            directory = self.settings["sample_directory"]
+        try:
+            return sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+        except OSError:
+            return None
+
+    def sample_size(self, names, size=None):
+        """Estimate the uncompressed input size of a sample pair.
+
+        :param names: the file names of the sample pair.
+        :param size: the size of the files on disk, read from the sample directory when not given.
+        :return: The estimated uncompressed size in bytes, or None if the files cannot be read.
+        """
+        if size is None:
+            size = self.input_bytes(names)
+            if size is None:
+                return None
+        if any(name.endswith(".gz") for name in names):
+            size *= GZIP_RATIO
+        return size
+
+    def entry_size(self, names, entry):
+        """Return the uncompressed input size of a sample pair in the ledger.
+
+        :param names: the file names of the sample pair.
+        :param entry: the ledger entry of the sample pair.
+        :return: The size of the staged files, or the estimate from the size on disk for entries which do not have it.
+        """
+        return entry.get("uncompressed_bytes") or self.sample_size(names, entry["input_bytes"])
+
+    def order_samples(self, slots, threads):
+        """Order the samples longest-first and print the expected plan on the slots.
+
+        The cost of a sample is its (uncompressed) input size times the seconds per byte of earlier completed samples,
+        preferably of samples which ran with the same amount of cores. Without history the plan is based on the sizes
+        alone. Since every slot takes the next sample when it finishes, handing out the longest samples first keeps a
+        big sample from running alone at the end of the batch.
+
+        :param slots: the amount of samples running at the same time.
+        :param threads: the amount of cores per sample.
+        """
+        history = [(key.split("|"), entry) for key, entry in self.ledger.items()
+                   if entry.get("state") == "completed" and entry.get("wall_time") and entry.get("input_bytes")]
+        same_threads = [(names, entry) for names, entry in history if entry.get("threads") == threads]
+        history = same_threads or history
+        rate = sum(entry["wall_time"] for names, entry in history) / \
+            sum(self.entry_size(names, entry) for names, entry in history) if history else None
+        costs = {sample: self.sample_size(sample) for sample in self.samples}
+        # A pair which cannot be read fails without running, so it goes first and costs nothing in the plan.
+        unknown = [sample for sample in self.samples if costs[sample] is None]
+        costs = {sample: (size or 0) * (rate or 1) for sample, size in costs.items()}
+        if self.settings["sample_order"] == "longest_first":
+            # next_sample takes the samples from the end of the list.
+            self.samples.sort(key=lambda sample: (sample in unknown, costs[sample]))
+
+        # Simulate how the slots pick up the samples.
+        finish = [0.0] * slots
+        print("Plan ({}):".format("expected seconds from {} earlier sample(s)".format(len(history)) if rate else
+                                 "relative cost from the input sizes, no earlier runs to learn from"))
+        for position, sample in enumerate(reversed(self.samples)):
+            slot = finish.index(min(finish))
+            start = finish[slot]
+            finish[slot] += costs[sample]
+            if sample in unknown:
+                print("  {:>3}. {} {}: slot {}, unknown size, the files cannot be read".format(
+                    position + 1, sample[0], sample[1], slot + 1))
+            elif rate:
+                print("  {:>3}. {} {}: slot {}, {:.0f} s, from {:.0f} s to {:.0f} s".format(
+                    position + 1, sample[0], sample[1], slot + 1, costs[sample], start, finish[slot]))
+            else:
+                print("  {:>3}. {} {}: slot {}, {:.1f} MB".format(position + 1, sample[0], sample[1], slot + 1,
+                                                                 costs[sample] / 10 ** 6))
+        if rate and self.samples:
+            print("Expected batch time: {:.0f} s".format(max(finish)))
 
-        command = "docker container run -it " + \
+    def plan_slots(self):
+        """Decide how many samples can run at the same time and which resources each of them gets.
+
+        :return: A tuple of (slots, cores per sample, memory per sample in GB or None). The number of slots is limited by
+        max_concurrent, the number of cores and, if given, by how many times sample_memory fits in memory_limit.
+        """
+        cores = int(self.settings["cores"])
+        slots = min(int(self.settings["max_concurrent"]), cores, max(len(self.samples), 1))
+        memory = None
+        if self.settings["memory_limit"] != "":
+            memory_limit = float(self.settings["memory_limit"])
+            if self.settings["sample_memory"] != "":
+                slots = max(1, min(slots, int(memory_limit // float(self.settings["sample_memory"]))))
+            memory = memory_limit / slots
+        return slots, cores // slots, memory
+
+    def set_status(self, sample, state):
+        """Record and print the state of a sample pair.
+
+        :param sample: the sample pair (tuple of two file names).
+        :param state: the new state, e.g. "queued", "running", "done" or "failed".
+        """
+        with self.status_lock:
+            self.status[sample] = (state, time.strftime("%Y-%m-%d %H:%M:%S"))
+            counts = {}
+            for sample_state, timestamp in self.status.values():
+                counts[sample_state] = counts.get(sample_state, 0) + 1
+            print("[{}] {} {}: {} ({})".format(self.status[sample][1], sample[0], sample[1], state,
+                                               ", ".join("{} {}".format(n, name) for name, n in counts.items())))
+
+    def container_stats(self, name):
+        """Take one sample of the resource usage of a running container with "<container_engine> stats".
+
+        :param name: the name of the container.
+        :return: A tuple of (used cores, memory in bytes), or None if the container engine gave no usable answer.
+        """
+        command = shlex.split(self.settings["container_engine"]) + [
+            "stats", "--no-stream", "--format", "{{.CPUPerc}}\t{{.MemUsage}}", name]
+        try:
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                                    timeout=60)
+            cpu, memory = result.stdout.strip().split("\t")
+            cores = float(cpu.strip().rstrip("%")) / 100
+        except (OSError, subprocess.SubprocessError, ValueError):
+            return None
+        memory = parse_memory(memory.split("/")[0])
+        if result.returncode != 0 or memory is None:
+            return None
+        return cores, memory
+
+    def container_name(self, sample):
+        """Return the name of the container which runs a sample pair, which is unique per wrapper process.
+
+        :param sample: the sample pair as it is given to ViroMatch.
+        """
+        return re.sub(r"[^a-zA-Z0-9_.-]", "_", "viromatch_{}_{}".format(sample[0], os.getpid()))
+
+    def stop_container(self, name):
+        """Stop a running container with "<container_engine> container stop", if it is running.
+
+        :param name: the name of the container.
+        """
+        command = shlex.split(self.settings["container_engine"]) + ["container", "stop", name]
+        try:
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=120)
+        except (OSError, subprocess.SubprocessError):
+            pass
+
+    def known_engine(self):
+        """Tell if the container engine is docker or podman, rather than a stand-in for it.
+
+        :return: True if one of the words of the container_engine setting is in CONTAINER_ENGINES.
+        """
+        return any(os.path.basename(word) in CONTAINER_ENGINES for word in shlex.split(self.settings["container_engine"]))
+
+    def container_cgroup(self, name):
+        """Find the cgroup directory of a running container, through the cgroup of its main process.
+
+        :param name: the name of the container.
+        :return: The cgroup directory, "" if the container runs but its cgroup cannot be read here (e.g. a remote
+        engine or cgroup version 1), or None if the container is not running (yet).
+        """
+        command = shlex.split(self.settings["container_engine"]) + [
+            "inspect", "--format", "{{.State.Pid}}", name]
+        try:
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                                    timeout=60)
+            pid = int(result.stdout.strip())
+        except (OSError, subprocess.SubprocessError, ValueError):
+            return None
+        if result.returncode != 0 or pid <= 0:
+            return None
+        try:
+            with open("/proc/{}/cgroup".format(pid)) as file:
+                for line in file:
+                    # The cgroup version 2 line looks like "0::/system.slice/docker-<id>.scope".
+                    if line.startswith("0::"):
+                        path = os.path.join("/sys/fs/cgroup", line[3:].strip().lstrip("/"))
+                        return path if cgroup_usage(path) is not None else ""
+        except OSError:
+            pass
+        return ""
+
+    def monitor_container(self, name, stop, usage):
+        """Follow the resource usage of a container until stop is set.
+
+        The cgroup of the container is read every CGROUP_INTERVAL seconds, as it holds the exact CPU time and peak
+        memory, but it is gone once the container is removed. If it cannot be read, the container engine is asked for
+        its stats every stats_interval seconds instead.
+
+        :param name: the name of the container.
+        :param stop: threading.Event which is set when the container exited.
+        :param usage: dictionary in which the last cgroup reading is kept, and the CPU time (cores times seconds
+        between samples), the peak memory and the amount of samples of the stats command.
+        """
+        interval = int(self.settings["stats_interval"])
+        # Stand-ins for docker do not run real containers, so they have no cgroup to look for.
+        cgroup = None if self.known_engine() else ""
+        last = time.perf_counter()
+        while not stop.wait(CGROUP_INTERVAL):
+            if cgroup is None:
+                cgroup = self.container_cgroup(name)
+            if cgroup:
+                reading = cgroup_usage(cgroup)
+                if reading is not None:
+                    usage["cgroup"] = reading
+                continue
+            now = time.perf_counter()
+            if now - last < interval:
+                continue
+            stats = self.container_stats(name)
+            if stats is not None:
+                usage["cpu_time"] += stats[0] * (now - last)
+                usage["max_memory"] = max(usage["max_memory"], stats[1])
+                usage["stats_samples"] += 1
+            last = now
+
+    def run_viromatch(self, sample=None, threads=None, memory=None, input_dir=None, usage=None):
+        """Run the actual viromatch command using the parsed settings.
+
+        While the container runs, its CPU and memory usage is read from its cgroup, or sampled with the stats command
+        of the container engine. If that gives nothing and the engine is not docker or podman (e.g. a local stand-in
+        for docker), the resource usage of the child process is used. For docker and podman that would only measure the
+        client, so the usage is left empty then.
+
+        :param sample: the sample pair to run, defaults to self.current_sample.
+        :param threads: the amount of cores for this sample, defaults to the cores setting.
+        :param memory: the memory limit in GB for the container, None for no limit.
+        :param input_dir: the directory which holds the (uncompressed) sample files, defaults to the sample directory.
+        :param usage: optional dictionary which is filled with the wall time, CPU time, peak memory (MB) and the source
+        of these numbers ("cgroup", "stats", "rusage" or None).
+        :return: The exit code of the container.
+        """
+        if sample is None:
+            sample = self.current_sample
+        if input_dir is None:
+            input_dir = self.settings["sample_directory"]
+        if threads is None:
+            threads = self.settings["cores"]
+        # Limit the container to its share of the machine.
+        resources = "--cpus {} ".format(threads)
+        if memory:
+            resources += "--memory {}m ".format(int(memory * 1024))
+
+        # The databases are shared by all samples, so they are mounted read-only.
+        databases = {key: self.databases.get(key, self.settings[key]) for key in DATABASES}
+        # The container gets a name to ask for its stats, so it is removed when it exits to free that name again.
+        name = self.container_name(sample)
+        command = "{engine} container run --rm --name " + name + " " + resources + \
                   "-v {sample_dir}:/data " + \
                   "-v {out_dir}:/outdir " + \
-                  "-v {nt_dir}:/nt " + \
-                  "-v {nr_dir}:/nr " + \
-                  "-v {viral_nt_dir}:/viralfna " + \
-                  "-v {viral_nr_dir}:/viralfaa " + \
-                  "-v {host_dir}:/host " + \
-                  "-v {adaptor_dir}:/adaptor " + \
-                  "-v {taxonomy_dir}:/taxonomy " + \
+                  "-v {nt_dir}:/nt:ro " + \
+                  "-v {nr_dir}:/nr:ro " + \
+                  "-v {viral_nt_dir}:/viralfna:ro " + \
+                  "-v {viral_nr_dir}:/viralfaa:ro " + \
+                  "-v {host_dir}:/host:ro " + \
+                  "-v {adaptor_dir}:/adaptor:ro " + \
+                  "-v {taxonomy_dir}:/taxonomy:ro " + \
                   "twylie/viromatch:latest viromatch " + \
                   "--smkcores {threads} " + \
                   "--sampleid {current_sample_1} " + \
@@ -153,19 +601,614 @@ class ViroMatchWrapper:
                   "--adaptor /adaptor/{adaptor_file} " + \
                   "--taxid /taxonomy/{taxonomy_file};"
 
-        command = command.format(sample_dir=self.settings["sample_directory"],
+        command = command.format(engine=self.settings["container_engine"],
+                                 sample_dir=input_dir,
                                  out_dir=self.settings["output_directory"],
-                                 nt_dir=self.settings["ncbi_nt"], nr_dir=self.settings["ncbi_nr"],
-                                 viral_nt_dir=self.settings["viral_nt"], viral_nr_dir=self.settings["viral_nr"],
-                                 host_dir=self.settings["host"], adaptor_dir=self.settings["adaptor"],
-                                 taxonomy_dir=self.settings["taxonomy"], threads=self.settings["cores"],
-                                 current_sample_1=self.current_sample[0], current_sample_2=self.current_sample[1],
+                                 nt_dir=databases["ncbi_nt"], nr_dir=databases["ncbi_nr"],
+                                 viral_nt_dir=databases["viral_nt"], viral_nr_dir=databases["viral_nr"],
+                                 host_dir=databases["host"], adaptor_dir=databases["adaptor"],
+                                 taxonomy_dir=databases["taxonomy"], threads=threads,
+                                 current_sample_1=sample[0], current_sample_2=sample[1],
                                  nt_file=self.settings["ncbi_nt_file"], nr_file=self.settings["ncbi_nr_file"],
                                  viral_nt_file=self.settings["viral_nt_file"],
                                  viral_nr_file=self.settings["viral_nr_file"],
                                  host_file=self.settings["host_file"], adaptor_file=self.settings["adaptor_file"],
                                  taxonomy_file=self.settings["taxonomy_file"])
-        subprocess.run(command, shell=True)
+        stats = {"cpu_time": 0.0, "max_memory": 0, "stats_samples": 0}
+        stop = threading.Event()
+        monitor = threading.Thread(target=self.monitor_container, args=(name, stop, stats), daemon=True)
+        start = time.perf_counter()
+        process = subprocess.Popen(command, shell=True)
+        monitor.start()
+        try:
+            # wait4 instead of wait, to get the resource usage of the child process as well.
+            status, rusage = os.wait4(process.pid, 0)[1:]
+            process.returncode = os.waitstatus_to_exitcode(status)
+        finally:
+            stop.set()
+            monitor.join()
+        if usage is not None:
+            usage["wall_time"] = round(time.perf_counter() - start, 1)
+            if "cgroup" in stats:
+                usage.update(cpu_time=round(stats["cgroup"][0], 1), max_memory_mb=round(stats["cgroup"][1] / 2 ** 20),
+                             resource_source="cgroup")
+            elif stats["stats_samples"]:
+                usage.update(cpu_time=round(stats["cpu_time"], 1), max_memory_mb=round(stats["max_memory"] / 2 ** 20),
+                             resource_source="stats")
+            elif not self.known_engine():
+                # ru_maxrss is in kilobytes on Linux.
+                usage.update(cpu_time=round(rusage.ru_utime + rusage.ru_stime, 1),
+                             max_memory_mb=round(rusage.ru_maxrss / 1024), resource_source="rusage")
+            else:
+                # The container ended before it could be measured.
+                usage.update(cpu_time=None, max_memory_mb=None, resource_source=None)
+        return process.returncode
+
+    def ledger_path(self):
+        """Return the location of the job ledger (of this worker, with a shared queue)."""
+        if self.shared_queue():
+            name, extension = os.path.splitext(LEDGER_FILE)
+            return os.path.join(self.settings["output_directory"], "{}.{}{}".format(name, self.worker_id, extension))
+        return os.path.join(self.settings["output_directory"], LEDGER_FILE)
+
+    def load_ledger(self):
+        """Load the job ledger of earlier runs from the output directory.
+
+        With a shared queue the ledgers of all workers are merged, keeping the most recently started entry of every
+        sample pair.
+
+        :return: The ledger is put in self.ledger, a dictionary of "sample_1|sample_2": dictionary with the state, exit
+        code, start and end time, output path and amount of attempts of that sample pair.
+        """
+        self.ledger = {}
+        paths = [self.ledger_path()]
+        if self.shared_queue():
+            name, extension = os.path.splitext(LEDGER_FILE)
+            with os.scandir(self.settings["output_directory"]) as entries:
+                paths = [entry.path for entry in entries
+                         if entry.name == LEDGER_FILE or entry.name.startswith(name + ".") and
+                         entry.name.endswith(extension)]
+        for path in paths:
+            if os.path.isfile(path):
+                with open(path) as file:
+                    for key, entry in json.load(file).items():
+                        if (entry.get("start") or "") >= (self.ledger.get(key, {}).get("start") or ""):
+                            self.ledger[key] = entry
+        self.own_entries = set()
+
+    def update_ledger(self, sample, **fields):
+        """Update the ledger entry of a sample pair and write the ledger to disk straight away.
+
+        :param sample: the sample pair (tuple of two file names).
+        :param fields: the fields of the entry to change.
+        """
+        with self.ledger_lock:
+            self.ledger.setdefault("|".join(sample), {}).update(fields)
+            self.own_entries.add("|".join(sample))
+            # With a shared queue, the ledger of this worker only holds the samples this worker ran.
+            ledger = {key: self.ledger[key] for key in self.own_entries} if self.shared_queue() else self.ledger
+            # Write to a temporary file first, so a crash never leaves a half-written ledger.
+            with open(self.ledger_path() + ".tmp", "w") as file:
+                json.dump(ledger, file, indent=2)
+            os.replace(self.ledger_path() + ".tmp", self.ledger_path())
+
+    def output_path(self, sample):
+        """Return the output directory ViroMatch writes a sample pair to."""
+        return os.path.join(self.settings["output_directory"], "{}_python_automated".format(self.run_names(sample)[0]))
+
+    def is_completed(self, sample):
+        """Check in the ledger if a sample pair finished successfully and its output is still present."""
+        entry = self.ledger.get("|".join(sample), {})
+        return entry.get("state") == "completed" and os.path.isdir(entry.get("output_path", ""))
+
+    def clear_incomplete_output(self, sample):
+        """Move a half-written output directory of a sample pair aside, so ViroMatch can start from scratch.
+
+        :param sample: the sample pair (tuple of two file names).
+        """
+        output_path = self.output_path(sample)
+        if os.path.isdir(output_path) and not self.is_completed(sample):
+            moved = "{}_incomplete_{}".format(output_path, time.strftime("%Y%m%d_%H%M%S"))
+            print("Moving incomplete output {} to {}".format(output_path, moved))
+            os.rename(output_path, moved)
+
+    def staging_directory(self):
+        """Return the scratch directory compressed samples are decompressed to."""
+        return self.settings["scratch_directory"] or os.path.join(self.settings["output_directory"], "staging")
+
+    @staticmethod
+    def run_names(sample):
+        """Return the file names ViroMatch gets for a sample pair, which are the names without a .gz extension.
+
+        :param sample: the sample pair (tuple of two file names).
+        :return: A tuple of the two file names as they are given to ViroMatch.
+        """
+        return tuple(name[:-3] if name.endswith(".gz") else name for name in sample)
+
+    def decompress_file(self, name, directory):
+        """Decompress a single gzipped sample file from the sample directory into a staging directory.
+
+        :param name: the name of the gzipped file.
+        :param directory: the directory to write the decompressed file to.
+        :return: The path of the decompressed file.
+        """
+        target = os.path.join(directory, name[:-3])
+        with gzip.open(os.path.join(self.settings["sample_directory"], name)) as source, \
+                open(target + ".part", "wb") as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+        os.replace(target + ".part", target)
+        return target
+
+    def start_staging(self, sample):
+        """Start decompressing the gzipped files of a sample pair in the background, if that has not started yet.
+
+        :param sample: the sample pair (tuple of two file names).
+        """
+        with self.staging_lock:
+            if sample in self.staging or not any(name.endswith(".gz") for name in sample):
+                return
+            directory = os.path.join(self.staging_directory(), self.run_names(sample)[0])
+            os.makedirs(directory, exist_ok=True)
+            self.staging[sample] = [self.staging_pool.submit(self.decompress_file, name, directory)
+                                    if name.endswith(".gz") else None for name in sample]
+
+    def stage_sample(self, sample):
+        """Make sure the input of a sample pair is available uncompressed and start staging the upcoming samples.
+
+        Staging of the samples after this one overlaps with the ViroMatch run of this sample.
+
+        :param sample: the sample pair (tuple of two file names).
+        :return: The directory which holds the uncompressed input of the sample pair.
+        """
+        self.start_staging(sample)
+        position = self.queue.index(sample)
+        for upcoming in self.queue[position + 1:position + 1 + self.staging_ahead]:
+            self.start_staging(upcoming)
+
+        if sample not in self.staging:
+            return self.settings["sample_directory"]
+        self.set_status(sample, "staging")
+        directory = os.path.join(self.staging_directory(), self.run_names(sample)[0])
+        for name, job in zip(sample, self.staging[sample]):
+            if job is None:
+                # Uncompressed mate of a compressed file, put it next to the decompressed one. A symbolic link would
+                # not resolve inside the container, so hard link it or copy it when it is on another file system.
+                link = os.path.join(directory, name)
+                if not os.path.exists(link):
+                    try:
+                        os.link(os.path.join(self.settings["sample_directory"], name), link)
+                    except OSError:
+                        shutil.copyfile(os.path.join(self.settings["sample_directory"], name), link)
+            else:
+                job.result()
+        return directory
+
+    def remove_staged(self, sample):
+        """Delete the staged (decompressed) files of a sample pair.
+
+        :param sample: the sample pair (tuple of two file names).
+        """
+        with self.staging_lock:
+            if self.staging.pop(sample, None) is not None:
+                shutil.rmtree(os.path.join(self.staging_directory(), self.run_names(sample)[0]), ignore_errors=True)
+                try:
+                    os.rmdir(self.staging_directory())
+                except OSError:
+                    # Other samples are still staged.
+                    pass
+
+    def run_sample(self, sample, threads, memory):
+        """Run a single sample pair, retrying it with an increasing delay, and keep track of it in the ledger.
+
+        :param sample: the sample pair to run.
+        :param threads: the amount of cores for this sample.
+        :param memory: the memory limit in GB for the container, None for no limit.
+        :return: The exit code of the last attempt.
+        """
+        try:
+            input_dir = self.stage_sample(sample)
+        except (OSError, EOFError, gzip.BadGzipFile, zlib.error) as staging_error:
+            self.remove_staged(sample)
+            self.update_ledger(sample, state="failed", exit_code=None, output_path=self.output_path(sample),
+                               **dict.fromkeys(MEASURED_COLUMNS))
+            self.set_status(sample, "failed (staging: {})".format(staging_error))
+            return None
+        try:
+            return self.run_attempts(sample, threads, memory, input_dir)
+        finally:
+            self.remove_staged(sample)
+
+    def run_attempts(self, sample, threads, memory, input_dir):
+        """Run a sample pair until it succeeds or the retries are used up.
+
+        :param sample: the sample pair to run.
+        :param threads: the amount of cores for this sample.
+        :param memory: the memory limit in GB for the container, None for no limit.
+        :param input_dir: the directory which holds the (uncompressed) sample files.
+        :return: The exit code of the last attempt.
+        """
+        # Count the reads while the sample runs, the files are read anyway.
+        input_bytes = self.input_bytes(sample)
+        # The staged files are decompressed, so their size is the real uncompressed size.
+        uncompressed_bytes = self.input_bytes(self.run_names(sample), input_dir)
+        read_counts = [self.staging_pool.submit(count_reads, os.path.join(input_dir, name))
+                       for name in self.run_names(sample)]
+        max_retries = int(self.settings["max_retries"])
+        exit_code = None
+        for attempt in range(max_retries + 1):
+            if attempt:
+                delay = int(self.settings["retry_delay"]) * 2 ** (attempt - 1)
+                self.set_status(sample, "retrying in {} s".format(delay))
+                time.sleep(delay)
+            if sample in self.lost:
+                # Another worker took the sample over and runs it in the same output directory.
+                self.set_status(sample, "lease lost")
+                return None
+            self.clear_incomplete_output(sample)
+            self.set_status(sample, "running")
+            attempts = self.ledger.get("|".join(sample), {}).get("attempts", 0) + 1
+            self.update_ledger(sample, state="running", exit_code=None, start=time.strftime("%Y-%m-%d %H:%M:%S"),
+                               end=None, output_path=self.output_path(sample), attempts=attempts,
+                               **dict.fromkeys(MEASURED_COLUMNS))
+            usage = {}
+            try:
+                exit_code = self.run_viromatch(self.run_names(sample), threads, memory, input_dir, usage)
+            except Exception:
+                self.update_ledger(sample, state="failed", end=time.strftime("%Y-%m-%d %H:%M:%S"))
+                self.set_status(sample, "failed")
+                raise
+            if sample in self.lost:
+                # The container was stopped, its exit code says nothing about the sample.
+                self.update_ledger(sample, state="lost", end=time.strftime("%Y-%m-%d %H:%M:%S"))
+                self.set_status(sample, "lease lost")
+                return None
+            state = "completed" if exit_code == 0 else "failed"
+            counts = [job.result() for job in read_counts]
+            reads = None if None in counts else sum(counts)
+            usage.update(threads=threads, input_bytes=input_bytes, uncompressed_bytes=uncompressed_bytes, reads=reads,
+                         cpu_efficiency=round(usage["cpu_time"] / (usage["wall_time"] * threads), 2)
+                         if usage["wall_time"] and usage["cpu_time"] is not None else None,
+                         reads_per_second=round(reads / usage["wall_time"], 1)
+                         if reads is not None and usage["wall_time"] else None,
+                         databases=self.database_mode, speedup=None)
+            if exit_code == 0 and self.database_mode != "direct" and self.baseline_rate and usage["wall_time"] and \
+                    uncompressed_bytes:
+                # Compare with the time earlier samples with direct database access took for the same input size.
+                expected = self.baseline_rate * uncompressed_bytes
+                usage["speedup"] = round(expected / usage["wall_time"], 2)
+                print("{} {}: {:.0f} s with {} databases, {:.0f} s expected from earlier runs with direct database "
+                      "access, speedup {:.2f}x".format(sample[0], sample[1], usage["wall_time"], self.database_mode,
+                                                        expected, usage["speedup"]))
+            self.update_ledger(sample, state=state, exit_code=exit_code, end=time.strftime("%Y-%m-%d %H:%M:%S"),
+                               **usage)
+            if exit_code == 0:
+                self.set_status(sample, "done")
+                break
+            self.set_status(sample, "failed (exit code {})".format(exit_code))
+        return exit_code
+
+    def sync_database(self, key, target):
+        """Copy a database directory to local scratch, only copying the files which changed since the last copy.
+
+        A manifest in the copy keeps the size and modification time (and with verify_databases the SHA-256) of every
+        source file. Files are copied to a temporary name first, so an interrupted copy is never used.
+
+        :param key: the setting of the database directory, e.g. "ncbi_nt".
+        :param target: the directory to copy the database to.
+        :return: A tuple of (copied files, copied bytes).
+        """
+        source = self.settings[key]
+        manifest_path = os.path.join(target, MANIFEST_FILE)
+        manifest = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+        verify = self.settings["verify_databases"] == "yes"
+
+        new_manifest = {}
+        copied = [0, 0]
+        for root, dirs, files in os.walk(source):
+            for name in files:
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, source)
+                stat = os.stat(path)
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime}
+                destination = os.path.join(target, relative)
+                known = manifest.get(relative, {})
+                unchanged = known.get("size") == entry["size"] and known.get("mtime") == entry["mtime"] and \
+                    os.path.isfile(destination) and os.path.getsize(destination) == entry["size"]
+                if verify:
+                    entry["sha256"] = known["sha256"] if unchanged and "sha256" in known else file_checksum(path)
+                    unchanged = unchanged and entry["sha256"] == file_checksum(destination)
+                if not unchanged:
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    shutil.copy2(path, destination + ".part")
+                    if verify and file_checksum(destination + ".part") != entry["sha256"]:
+                        sys.exit("The copy of {} does not match the original, not using the database copy.".format(
+                            path))
+                    os.replace(destination + ".part", destination)
+                    copied[0] += 1
+                    copied[1] += entry["size"]
+                new_manifest[relative] = entry
+
+        # Files which disappeared from the source should not linger in the copy.
+        for relative in set(manifest) - set(new_manifest):
+            try:
+                os.remove(os.path.join(target, relative))
+            except OSError:
+                pass
+        with open(manifest_path + ".tmp", "w") as file:
+            json.dump(new_manifest, file, indent=2)
+        os.replace(manifest_path + ".tmp", manifest_path)
+        return tuple(copied)
+
+    def prepare_databases(self):
+        """Copy the databases to the database_cache directory and/or prefetch them into the page cache.
+
+        The samples mount the resulting directories read-only. The wall time per input byte of earlier samples which
+        read the databases straight from their original location is kept as the baseline for the speedup. Wrappers on
+        the same host which share the database_cache take turns through a lock file, the later ones then find the
+        copies up to date.
+        """
+        self.databases = {key: self.settings[key] for key in DATABASES}
+        modes = []
+        if self.settings["database_cache"]:
+            modes.append("cache")
+            try:
+                os.makedirs(self.settings["database_cache"], exist_ok=True)
+                lock = open(os.path.join(self.settings["database_cache"], SYNC_LOCK_FILE), "a")
+            except OSError as lock_error:
+                sys.exit("Something went wrong with locking the database cache {}. Error: {}".format(
+                    self.settings["database_cache"], lock_error))
+            with lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print("Waiting for another wrapper to finish copying the databases")
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                for key in DATABASES:
+                    target = os.path.join(self.settings["database_cache"], key)
+                    start = time.perf_counter()
+                    try:
+                        copied, size = self.sync_database(key, target)
+                    except OSError as copy_error:
+                        sys.exit("Something went wrong with copying the {} database to {}. Error: {}".format(
+                            key, target, copy_error))
+                    print("Database {}: copied {} file(s), {:.1f} GB to {} in {:.0f} s".format(
+                        key, copied, size / 10 ** 9, target, time.perf_counter() - start))
+                    self.databases[key] = target
+        if self.settings["prefetch_databases"] == "yes":
+            modes.append("prefetch")
+            for key in DATABASES:
+                start = time.perf_counter()
+                size = prefetch_directory(self.databases[key])
+                print("Database {}: prefetched {:.1f} GB in {:.0f} s".format(key, size / 10 ** 9,
+                                                                           time.perf_counter() - start))
+        self.database_mode = "+".join(modes) or "direct"
+
+        # Samples from before the database options have no "databases" field, they read the databases directly.
+        # The rate is per uncompressed byte, so gzipped and uncompressed samples can be compared.
+        direct = [(key.split("|"), entry) for key, entry in self.ledger.items()
+                  if entry.get("databases", "direct") == "direct" and entry.get("state") == "completed" and
+                  entry.get("wall_time") and entry.get("input_bytes")]
+        self.baseline_rate = sum(entry["wall_time"] for names, entry in direct) / \
+            sum(self.entry_size(names, entry) for names, entry in direct) if direct else None
+
+    def shared_queue(self):
+        """Check if the samples are pulled from the queue shared with wrappers on other hosts."""
+        return self.settings["queue_mode"] == "shared"
+
+    def claim_path(self, sample, suffix):
+        """Return the path of the claim (or marker) file of a sample pair in the shared queue directory.
+
+        :param sample: the sample pair (tuple of two file names).
+        :param suffix: ".claim" while a worker runs the sample, ".done" or ".failed" afterwards.
+        """
+        return os.path.join(self.settings["output_directory"], QUEUE_DIRECTORY,
+                            re.sub(r"[^a-zA-Z0-9_.-]", "_", "|".join(sample)) + suffix)
+
+    def claim_owner(self, path):
+        """Return the worker which holds a claim file, or None if it can not be read."""
+        try:
+            with open(path) as file:
+                return json.load(file)["worker"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def reclaim(self, path):
+        """Take over the claim of a worker which stopped sending heartbeats.
+
+        The expired claim is renamed first, only one worker can succeed in that. If the claim turns out to have been
+        renewed in the meantime, it is put back.
+
+        :param path: the claim file.
+        :return: True if the claim may be created again, False if it is still held by another worker.
+        """
+        lease_time = int(self.settings["lease_time"])
+        try:
+            if time.time() - os.stat(path).st_mtime < lease_time:
+                return False
+        except FileNotFoundError:
+            # Released in the meantime.
+            return True
+        expired = "{}.expired.{}".format(path, self.worker_id)
+        try:
+            os.rename(path, expired)
+        except FileNotFoundError:
+            return False
+        if time.time() - os.stat(expired).st_mtime < lease_time:
+            try:
+                os.link(expired, path)
+            except FileExistsError:
+                pass
+            os.remove(expired)
+            return False
+        print("Reclaiming {}, the lease of {} expired".format(os.path.basename(path), self.claim_owner(expired)))
+        os.remove(expired)
+        return True
+
+    def try_claim(self, sample):
+        """Try to claim a sample pair in the shared queue, creating the claim file only if it does not exist yet.
+
+        :param sample: the sample pair (tuple of two file names).
+        :return: True if this worker now holds the claim.
+        """
+        path = self.claim_path(sample, ".claim")
+        for attempt in range(2):
+            try:
+                descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if attempt or not self.reclaim(path):
+                    return False
+                continue
+            with os.fdopen(descriptor, "w") as file:
+                json.dump({"worker": self.worker_id, "claimed": time.strftime("%Y-%m-%d %H:%M:%S")}, file)
+            with self.claims_lock:
+                self.claims.add(sample)
+            return True
+        return False
+
+    def claim_next(self):
+        """Claim the next sample pair of the shared queue which is neither finished nor held by another worker.
+
+        :return: A tuple of the claimed sample pair (None if there is nothing to claim right now) and the amount of
+        unfinished samples held by other workers.
+        """
+        held_elsewhere = 0
+        with self.queue_lock:
+            for sample in self.queue:
+                if sample in self.status and self.status[sample][0] != "queued":
+                    continue
+                if os.path.exists(self.claim_path(sample, ".done")) or \
+                        os.path.exists(self.claim_path(sample, ".failed")):
+                    self.set_status(sample, "finished elsewhere")
+                    continue
+                if not self.try_claim(sample):
+                    held_elsewhere += 1
+                    continue
+                # A worker may have finished the sample just before it lost its lease.
+                if os.path.exists(self.claim_path(sample, ".done")):
+                    self.release_claim(sample, None)
+                    self.set_status(sample, "finished elsewhere")
+                    continue
+                self.set_status(sample, "claimed")
+                return sample, held_elsewhere
+        return None, held_elsewhere
+
+    def release_claim(self, sample, state):
+        """Mark a claimed sample pair as finished and remove its claim.
+
+        :param sample: the sample pair (tuple of two file names).
+        :param state: "done", "failed", or None to only remove the claim.
+        """
+        if state is not None:
+            with open(self.claim_path(sample, "." + state), "w") as file:
+                json.dump({"worker": self.worker_id, "finished": time.strftime("%Y-%m-%d %H:%M:%S")}, file)
+        with self.claims_lock:
+            self.claims.discard(sample)
+        # Only remove the claim if it was not taken over by another worker.
+        if self.claim_owner(self.claim_path(sample, ".claim")) == self.worker_id:
+            os.remove(self.claim_path(sample, ".claim"))
+
+    def heartbeat(self, stop):
+        """Renew the leases of the claims of this worker every heartbeat_interval seconds until stop is set.
+
+        A claim which another worker took over is dropped and the container of that sample is stopped, as the other
+        worker runs it again in the same output directory. The stop is repeated every heartbeat until the sample is
+        released, in case its container was just starting.
+
+        :param stop: threading.Event which is set when the batch is finished.
+        """
+        while not stop.wait(int(self.settings["heartbeat_interval"])):
+            with self.claims_lock:
+                claims = list(self.claims)
+            for sample in claims:
+                path = self.claim_path(sample, ".claim")
+                owner = self.claim_owner(path)
+                if owner is None:
+                    # Being checked by another worker, or not written yet, try again next time.
+                    continue
+                if owner != self.worker_id:
+                    print("Lost the lease on {} {} to {}, stopping it here".format(sample[0], sample[1], owner))
+                    with self.claims_lock:
+                        self.claims.discard(sample)
+                        self.lost.add(sample)
+                    continue
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            with self.claims_lock:
+                lost = list(self.lost)
+            for sample in lost:
+                self.stop_container(self.container_name(self.run_names(sample)))
+
+    def queue_worker(self, threads, memory):
+        """Keep claiming and running sample pairs from the shared queue until all of them are finished.
+
+        :param threads: the amount of cores per sample.
+        :param memory: the memory limit in GB per sample, None for no limit.
+        """
+        while True:
+            sample, held_elsewhere = self.claim_next()
+            if sample is None:
+                if not held_elsewhere:
+                    return
+                # Wait for the other workers, their claims are taken over if their leases expire.
+                time.sleep(int(self.settings["heartbeat_interval"]))
+                continue
+            exit_code = None
+            try:
+                exit_code = self.run_sample(sample, threads, memory)
+            finally:
+                with self.claims_lock:
+                    lost = sample in self.lost
+                    self.lost.discard(sample)
+                # The marker of a sample which was taken over is left to the worker which runs it now.
+                self.release_claim(sample, None if lost else "done" if exit_code == 0 else "failed")
+                self.ran.append(sample)
+
+    def prepare_queue(self):
+        """Create the shared queue directory and clear the markers a new run should not trust.
+
+        Failed samples are tried again by every new run, like in the local mode, and samples marked done whose output
+        was removed run again.
+        """
+        os.makedirs(os.path.join(self.settings["output_directory"], QUEUE_DIRECTORY), exist_ok=True)
+        for sample in self.samples:
+            for state in ("done", "failed"):
+                marker = self.claim_path(sample, "." + state)
+                if os.path.exists(marker) and (state == "failed" or not os.path.isdir(self.output_path(sample))):
+                    try:
+                        os.remove(marker)
+                    except OSError:
+                        pass
+
+    def write_report(self, samples, wall_time):
+        """Write the resource usage of the samples of this batch to the report file and print a summary.
+
+        :param samples: the sample pairs which ran in this batch.
+        :param wall_time: the wall time of the whole batch in seconds.
+        """
+        rows = [self.ledger.get("|".join(sample), {}) for sample in samples]
+        report_path = os.path.join(self.settings["output_directory"], REPORT_FILE)
+        if self.shared_queue():
+            report_path = "{}.{}{}".format(os.path.splitext(report_path)[0], self.worker_id,
+                                           os.path.splitext(report_path)[1])
+        with open(report_path, "w") as file:
+            file.write("\t".join(("sample_1", "sample_2") + REPORT_COLUMNS) + "\n")
+            for sample, row in zip(samples, rows):
+                values = [row.get(column) for column in REPORT_COLUMNS]
+                file.write("\t".join(list(sample) + ["" if value is None else str(value) for value in values]) + "\n")
+
+        measured = [row for row in rows if row.get("cpu_efficiency") is not None]
+        print("\nBatch of {} sample(s) took {:.0f} s, report written to {}".format(len(samples), wall_time, report_path))
+        if measured:
+            # A low CPU efficiency means the samples could do with fewer cores each and more of them at a time.
+            print("Mean CPU efficiency {:.0%} of the given cores, peak memory {} MB, {:.0f} reads/s per sample".format(
+                sum(row["cpu_efficiency"] for row in measured) / len(measured),
+                max(row["max_memory_mb"] for row in measured),
+                sum(row["reads_per_second"] or 0 for row in measured) / len(measured)))
 
     def viromatch_wrapper(self):
         """The actual wrapper function which runs all the functions needed to run the ViroMatch samples."""
@@ -175,11 +1218,57 @@ class ViroMatchWrapper:
         print("samples:", self.samples)
         for samples in self.samples:
             (print(samples))
-        self.next_sample()
-        while self.current_sample:
-            print("\nRunning samples {} and {}\n".format(self.current_sample[0], self.current_sample[1]))
-            self.run_viromatch()
-            self.next_sample()
+        # Skip the samples which finished in an earlier run.
+        self.load_ledger()
+        skipped = [sample for sample in self.samples if self.is_completed(sample)]
+        for sample in skipped:
+            print("Skipping {} and {}, already completed".format(sample[0], sample[1]))
+        self.samples = [sample for sample in self.samples if sample not in skipped]
+        if self.samples:
+            self.prepare_databases()
+        slots, threads, memory = self.plan_slots()
+        print("\nRunning {} sample(s) at a time with {} core(s){} each\n".format(
+            slots, threads, "" if memory is None else " and {:.1f} GB memory".format(memory)))
+        self.order_samples(slots, threads)
+        print()
+        for sample in self.samples:
+            self.set_status(sample, "queued")
+        # Hand the samples to the slots in the order next_sample gives them. Compressed samples are staged one round
+        # of slots ahead, so decompressing overlaps with the running samples.
+        self.queue = list(reversed(self.samples))
+        batch = list(self.samples)
+        start = time.perf_counter()
+        self.staging_ahead = slots
+        jobs = []
+        with ThreadPoolExecutor(max_workers=int(self.settings["staging_workers"])) as self.staging_pool, \
+                ThreadPoolExecutor(max_workers=slots) as pool:
+            if self.shared_queue():
+                # Every slot claims its own samples from the queue shared with the other hosts. Samples are only
+                # staged once claimed, the next one in line may well be claimed by another host.
+                print("Worker {} pulling samples from {}\n".format(
+                    self.worker_id, os.path.join(self.settings["output_directory"], QUEUE_DIRECTORY)))
+                self.prepare_queue()
+                self.staging_ahead = 0
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=self.heartbeat, args=(stop,), daemon=True)
+                heartbeat.start()
+                try:
+                    jobs = [pool.submit(self.queue_worker, threads, memory) for slot in range(slots)]
+                    for job in jobs:
+                        job.result()
+                finally:
+                    stop.set()
+                    heartbeat.join()
+                batch = self.ran
+            else:
+                self.next_sample()
+                while self.current_sample:
+                    jobs.append(pool.submit(self.run_sample, self.current_sample, threads, memory))
+                    self.next_sample()
+        # Raise errors which stopped a sample from running at all.
+        for job in jobs:
+            job.result()
+        self.write_report(batch, time.perf_counter() - start)
 
 
 def test_creation():